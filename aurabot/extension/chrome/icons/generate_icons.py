@@ -8,7 +8,10 @@ try:
     from PIL import Image, ImageDraw
 except ImportError:
     print("Pillow not installed. Installing...")
-    os.system(f"{sys.executable} -m pip install Pillow")
+    # pillow-simd is a drop-in Pillow build with SIMD resampling; it needs a
+    # compiler, so fall back to stock Pillow if it can't be built.
+    if os.system(f"{sys.executable} -m pip install pillow-simd") != 0:
+        os.system(f"{sys.executable} -m pip install Pillow")
     from PIL import Image, ImageDraw
 
 
@@ -44,7 +47,8 @@ def create_icon(size, output_path):
             width=line_width
         )
     
-    img.save(output_path, 'PNG')
+    # Icons are tiny; skip zlib's slow levels and the optimize filter search
+    img.save(output_path, 'PNG', compress_level=1, optimize=False)
     print(f"Created {output_path} ({size}x{size})")
 
 
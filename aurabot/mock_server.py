@@ -5,6 +5,7 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
+import random
 import uvicorn
 
 app = FastAPI(title="Aura Mock Server")
@@ -67,7 +68,6 @@ def chat(request: ChatRequest):
         "I see you've captured several code snippets related to React hooks. These might be useful for your current project.",
         "Your meeting notes show you're planning a pivot to enterprise. I've identified 3 key action items from your recent notes."
     ]
-    import random
     return {"response": random.choice(responses)}
 
 @app.get("/config")
@@ -0,0 +1,404 @@
+"""
+Shared Gemma embedding model and on-disk embedding cache for the servers.
+
+Importing this module does not load anything; call get_embedder() to get
+the process-wide GemmaEmbedder, so scripts running in the same process share
+one copy of the weights, tokenizer and torch.compile cache. Servers embed
+through get_embed_batcher(), which runs every forward pass on one thread.
+"""
+
+import os
+import time
+import queue
+import hashlib
+import sqlite3
+import threading
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Dict, Any
+
+MODELS_DIR = Path(os.getenv("MODELS_DIR", "./models"))
+# Texts per forward pass
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+# Token lengths batches are padded up to, so the compiled model sees a few
+# fixed shapes instead of recompiling for every new length
+EMBED_LENGTH_BUCKETS = (64, 128, 256, 512, 1024, 2048, 8192)
+EMBED_COMPILE = os.getenv("EMBED_COMPILE", "1") == "1"
+# Tokenized texts kept so a text embedded twice is tokenized once
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "2048"))
+# How long the embedding batcher waits for concurrent requests to join one
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+# "int8": bitsandbytes weights on CUDA, ONNX Runtime int8 (or torch dynamic
+# int8) on CPU; "none" keeps FP16 on CUDA and FP32 on CPU
+EMBED_QUANTIZE = os.getenv("EMBED_QUANTIZE", "int8").lower()
+# "auto": llama.cpp when the GGUF file and llama-cpp-python are present,
+# otherwise transformers; "llama" or "transformers" to force one
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "auto").lower()
+EMBED_GGUF = MODELS_DIR / os.getenv("EMBED_GGUF", "embeddinggemma-300m-qat-q8_0.gguf")
+
+
+class DiskEmbeddingCache:
+    """Embedding vectors in an fp16 memmap, indexed by text hash in SQLite.
+    
+    Not thread-safe on its own; callers serialize access with their own
+    cache lock. Keyed by content hash, so one directory per model.
+    """
+    
+    GROW_ROWS = 65536
+    
+    def __init__(self, directory: Path, dims: int):
+        import numpy as np
+        
+        directory.mkdir(parents=True, exist_ok=True)
+        self.dims = dims
+        self.data_path = directory / "cache.f16"
+        self.db = sqlite3.connect(str(directory / "cache_index.sqlite"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS rows (key BLOB PRIMARY KEY, row INTEGER NOT NULL)")
+        self.size = self.db.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+        
+        row_bytes = dims * np.dtype(np.float16).itemsize
+        capacity = self.data_path.stat().st_size // row_bytes if self.data_path.exists() else 0
+        self.data = None
+        self._resize(max(capacity, self.size, self.GROW_ROWS))
+    
+    def _resize(self, rows: int):
+        import numpy as np
+        
+        if self.data is not None:
+            self.data.flush()
+        with open(self.data_path, "ab") as f:
+            f.truncate(rows * self.dims * np.dtype(np.float16).itemsize)
+        self.data = np.memmap(self.data_path, dtype=np.float16, mode="r+", shape=(rows, self.dims))
+    
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, Any]:
+        """Look up keys, returning float32 vectors for the ones present."""
+        import numpy as np
+        
+        found = {}
+        # Stay well under SQLite's bound-parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            found.update(self.db.execute(
+                f"SELECT key, row FROM rows WHERE key IN ({marks})", chunk
+            ).fetchall())
+        return {key: np.asarray(self.data[row], dtype=np.float32) for key, row in found.items()}
+    
+    def put_many(self, items: List[tuple]):
+        """Append (key, vector) pairs that are not stored yet."""
+        new_rows = []
+        for key, emb in items:
+            if self.db.execute("SELECT 1 FROM rows WHERE key = ?", (key,)).fetchone():
+                continue
+            if self.size >= self.data.shape[0]:
+                self._resize(self.data.shape[0] + self.GROW_ROWS)
+            self.data[self.size] = emb
+            new_rows.append((key, self.size))
+            self.size += 1
+        if new_rows:
+            self.db.executemany("INSERT INTO rows (key, row) VALUES (?, ?)", new_rows)
+            self.db.commit()
+    
+    def close(self):
+        self.data.flush()
+        self.db.close()
+
+
+def pool_and_normalize(token_embeddings, attention_mask):
+    """Masked mean pool as one contraction, then L2-normalize."""
+    import torch
+    mask = attention_mask.to(token_embeddings.dtype)
+    # Dividing the weights first keeps FP16 sums over long inputs in range
+    weights = mask / mask.sum(dim=1, keepdim=True).clamp_min(1)
+    pooled = torch.einsum("bsd,bs->bd", token_embeddings, weights)
+    return torch.nn.functional.normalize(pooled.float(), p=2, dim=1)
+
+
+def load_onnx_int8(path: Path):
+    """Export to ONNX and dynamically quantize to int8 once, then load in ONNX Runtime."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    
+    onnx_path = path / "onnx"
+    int8_path = path / "onnx-int8"
+    if not any(int8_path.glob("*.onnx")):
+        if not (onnx_path / "model.onnx").exists():
+            from optimum.exporters.onnx import main_export
+            print(f"[INFO] Exporting embedding model to ONNX at {onnx_path}...")
+            main_export(
+                model_name_or_path=str(path),
+                output=onnx_path,
+                task="feature-extraction",
+                trust_remote_code=True,
+            )
+        print(f"[INFO] Quantizing ONNX embedding model to int8 at {int8_path}...")
+        quantizer = ORTQuantizer.from_pretrained(onnx_path)
+        quantizer.quantize(
+            save_dir=int8_path,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False),
+        )
+    return ORTModelForFeatureExtraction.from_pretrained(int8_path)
+
+
+class GemmaEmbedder:
+    """Google Embedding Gemma for vector embeddings."""
+    
+    def __init__(self):
+        self.model = None
+        self.tokenizer = None
+        self.device = "cpu"
+        # "llama" (llama.cpp) or "transformers", set by load()
+        self.backend = "transformers"
+        # Forward passes run one at a time (batcher thread and classifier)
+        self._lock = threading.Lock()
+        self._pool = pool_and_normalize
+        # Token ids of recently embedded texts; the classifier's semantic
+        # lookup and Mem0's add embed the same text back to back
+        self._tok_cache: "OrderedDict[bytes, Dict[str, List[int]]]" = OrderedDict()
+        
+        try:
+            import torch
+            if torch.cuda.is_available():
+                self.device = "cuda"
+                print(f"[OK] Using CUDA for embeddings")
+        except:
+            pass
+    
+    def load(self) -> bool:
+        if self.model is not None:
+            return True
+        
+        if EMBED_BACKEND in ("auto", "llama") and self._load_llama():
+            return True
+        if EMBED_BACKEND == "llama":
+            print("[WARN] llama.cpp embedder unavailable, falling back to transformers")
+        
+        from transformers import AutoTokenizer, AutoModel
+        import torch
+        
+        path = MODELS_DIR / "embeddinggemma-300m-f8"
+        if not path.exists():
+            print(f"[WARN] Gemma embedder not found at {path}")
+            print(f"       Embeddings will not work!")
+            return False
+        
+        print("[INFO] Loading Gemma embedding model...")
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            path, trust_remote_code=True, local_files_only=True
+        )
+        
+        if self.device == "cpu" and EMBED_QUANTIZE == "int8":
+            try:
+                self.model = load_onnx_int8(path)
+                print("[OK] Embedding model ready (ONNX Runtime int8)")
+                return True
+            except ImportError:
+                print("[INFO] optimum[onnxruntime] not installed, using torch dynamic int8")
+        
+        # int8 weights halve the bytes read per matmul on the GPU
+        quantization_config = None
+        if self.device == "cuda" and EMBED_QUANTIZE == "int8":
+            if importlib.util.find_spec("bitsandbytes") is not None:
+                from transformers import BitsAndBytesConfig
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+            else:
+                print("[INFO] bitsandbytes not installed, embedding weights stay FP16")
+        
+        self.model = AutoModel.from_pretrained(
+            path, trust_remote_code=True, local_files_only=True,
+            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
+            device_map="auto" if self.device == "cuda" else None,
+            quantization_config=quantization_config,
+        )
+        if self.device == "cpu":
+            self.model.to(self.device)
+            if EMBED_QUANTIZE == "int8":
+                self.model = torch.ao.quantization.quantize_dynamic(
+                    self.model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+        self.model.eval()
+        
+        if EMBED_COMPILE:
+            try:
+                import torch._dynamo
+                torch._dynamo.config.suppress_errors = True
+                # Default mode, not "reduce-overhead": CUDA graphs belong to the
+                # recording thread and every unpadded batch size is a new
+                # shape. Dynamo marks the batch dimension dynamic after the
+                # first recompile, so the length buckets stay a few graphs.
+                self.model = torch.compile(self.model)
+                self._pool = torch.compile(pool_and_normalize)
+                # Compile the static and dynamic-batch graphs up front
+                for bs in (1, 2, 4):
+                    self._forward(self._tokenize(["x"] * bs), EMBED_LENGTH_BUCKETS[0])
+                print("[OK] Embedding model compiled")
+            except Exception as e:
+                print(f"[WARN] torch.compile unavailable, running eagerly: {e}")
+        
+        print("[OK] Embedding model ready")
+        return True
+    
+    def _load_llama(self) -> bool:
+        """Load the q8_0 GGUF through llama.cpp, which pools inside its own kernels."""
+        if not EMBED_GGUF.exists() or importlib.util.find_spec("llama_cpp") is None:
+            return False
+        from llama_cpp import Llama
+        
+        print(f"[INFO] Loading Gemma embedding model from {EMBED_GGUF} (llama.cpp)...")
+        self.model = Llama(
+            model_path=str(EMBED_GGUF),
+            embedding=True,
+            n_ctx=EMBED_LENGTH_BUCKETS[-1],
+            # Embedding inputs must fit one batch
+            n_batch=EMBED_LENGTH_BUCKETS[-1],
+            n_threads=os.cpu_count(),
+            # Offloads to CUDA/Metal when llama.cpp was built with it
+            n_gpu_layers=-1,
+            verbose=False,
+        )
+        self.backend = "llama"
+        print("[OK] Embedding model ready (llama.cpp)")
+        return True
+    
+    def embed(self, texts: List[str]):
+        """Embed texts into a (len(texts), 768) float32 NumPy array."""
+        import numpy as np
+        
+        if self.model is None:
+            if not self.load():
+                return np.zeros((len(texts), 768), dtype=np.float32)
+        if not texts:
+            return np.zeros((0, 768), dtype=np.float32)
+        
+        if self.backend == "llama":
+            with self._lock:
+                result = self.model.create_embedding(texts)
+            embeddings = np.array([d["embedding"] for d in result["data"]], dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            return embeddings / np.maximum(norms, 1e-12)
+        
+        embeddings = np.empty((len(texts), 768), dtype=np.float32)
+        with self._lock:
+            features = self._tokenize(texts)
+            # Group texts by length bucket so short texts aren't padded to
+            # the length of a long neighbour, then scatter back in order
+            buckets: Dict[int, List[int]] = {}
+            for i, f in enumerate(features):
+                length = len(f["input_ids"])
+                bucket = next(b for b in EMBED_LENGTH_BUCKETS if b >= length)
+                buckets.setdefault(bucket, []).append(i)
+            for bucket, indices in sorted(buckets.items()):
+                for start in range(0, len(indices), EMBED_BATCH_SIZE):
+                    batch = indices[start:start + EMBED_BATCH_SIZE]
+                    embeddings[batch] = self._forward([features[i] for i in batch], bucket)
+        return embeddings
+    
+    def _tokenize(self, texts: List[str]) -> List[Dict[str, List[int]]]:
+        """Token ids per text, tokenizing only those not in the cache."""
+        keys = [hashlib.blake2b(text.encode(), digest_size=16).digest() for text in texts]
+        features: List[Any] = [self._tok_cache.get(key) for key in keys]
+        misses = [i for i, f in enumerate(features) if f is None]
+        for key, f in zip(keys, features):
+            if f is not None:
+                self._tok_cache.move_to_end(key)
+        if misses:
+            encoded = self.tokenizer(
+                [texts[i] for i in misses], truncation=True, max_length=EMBED_LENGTH_BUCKETS[-1]
+            )
+            for j, i in enumerate(misses):
+                features[i] = {k: encoded[k][j] for k in encoded.keys()}
+                self._tok_cache[keys[i]] = features[i]
+            while len(self._tok_cache) > TOKEN_CACHE_SIZE:
+                self._tok_cache.popitem(last=False)
+        return features
+    
+    def _forward(self, features: List[Dict[str, List[int]]], bucket: int):
+        """One forward pass over features padded to bucket tokens."""
+        import torch
+        
+        encoded = self.tokenizer.pad(
+            features, padding="max_length", max_length=bucket, return_tensors="pt"
+        )
+        if self.device == "cuda":
+            # Pinned host buffers let the copy to the GPU run asynchronously
+            encoded = {k: v.pin_memory().to(self.device, non_blocking=True) for k, v in encoded.items()}
+        else:
+            encoded = dict(encoded)
+        
+        with torch.inference_mode():
+            output = self.model(**encoded)
+            return self._pool(output[0], encoded["attention_mask"]).cpu().numpy()
+
+
+@lru_cache(maxsize=1)
+def get_embedder() -> GemmaEmbedder:
+    """The process-wide embedder; call load() (idempotent) before use."""
+    return GemmaEmbedder()
+
+
+class EmbedBatcher:
+    """Coalesces concurrent embed calls into shared forward passes.
+    
+    The model only ever runs on this batcher's thread, so handler threads
+    share batches instead of queuing on the embedder lock one at a time.
+    """
+    
+    def __init__(self, embedder: GemmaEmbedder,
+                 max_batch: int = EMBED_BATCH_SIZE,
+                 max_wait_ms: float = EMBED_BATCH_WAIT_MS):
+        self.embedder = embedder
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[tuple[List[str], Future]]" = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def submit(self, texts: List[str]):
+        """Queue texts for embedding and block until their vectors are ready."""
+        future: Future = Future()
+        self._queue.put((texts, future))
+        return future.result()
+    
+    def _collect(self) -> List[tuple]:
+        """Wait for one request, then gather more until the batch is full or the window closes."""
+        pending = [self._queue.get()]
+        count = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item)
+            count += len(item[0])
+        return pending
+    
+    def _run(self):
+        while True:
+            pending = self._collect()
+            texts = [text for batch, _ in pending for text in batch]
+            try:
+                embeddings = self.embedder.embed(texts)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            
+            # Hand each caller back its own slice, in submission order
+            offset = 0
+            for batch, future in pending:
+                future.set_result(embeddings[offset:offset + len(batch)])
+                offset += len(batch)
+
+
+@lru_cache(maxsize=1)
+def get_embed_batcher() -> EmbedBatcher:
+    """The process-wide batcher in front of get_embedder()."""
+    return EmbedBatcher(get_embedder())
@@ -17,19 +17,36 @@ Environment Variables:
 - MEM0_PORT: Server port (default: 8000)
 - GGUF_MODEL_PATH: Path to your .gguf file (auto-detected if not set)
 - GGUF_SERVER_PORT: Port for llama.cpp server (default: 8080)
+- GGUF_PARALLEL: Parallel decode slots in llama.cpp (default: 4)
+- GGUF_GPU_LAYERS: Layers offloaded to the GPU, if any (default: 99 = all)
+- GGUF_KEEPALIVE_SECONDS: Interval for 1-token keep-alive pings (default: 60, 0 disables)
 - LLAMA_CPP_PATH: Path to llama.cpp build directory
+- EMBED_QUANTIZE: "int8" (default) loads embedding weights in int8 on CUDA
+  when bitsandbytes is installed; "none" keeps them in BF16/FP16
 """
 
 import os
+import re
 import sys
+import atexit
+import signal
 import json
 import uuid
 import time
+import struct
+import hashlib
+import threading
 import subprocess
+import contextlib
+import importlib.util
+import numpy as np
 import requests
+import torch
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
+from collections import OrderedDict, deque
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 
@@ -41,12 +58,57 @@ try:
 except ImportError:
     pass
 
+# orjson is optional: faster JSON and native NumPy array serialization
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    orjson = None
+    HAS_ORJSON = False
+
 # Configuration
 HOST = os.getenv("MEM0_HOST", "localhost")
 PORT = int(os.getenv("MEM0_PORT", "8000"))
 GGUF_SERVER_PORT = int(os.getenv("GGUF_SERVER_PORT", "8080"))
+GGUF_PARALLEL = int(os.getenv("GGUF_PARALLEL", "4"))
+GGUF_GPU_LAYERS = int(os.getenv("GGUF_GPU_LAYERS", "99"))
+GGUF_KEEPALIVE_SECONDS = float(os.getenv("GGUF_KEEPALIVE_SECONDS", "60"))
 LLAMA_CPP_PATH = os.getenv("LLAMA_CPP_PATH", "")
 MODELS_DIR = Path(os.getenv("MODELS_DIR", "./models"))
+CLASSIFY_CACHE_SIZE = int(os.getenv("CLASSIFY_CACHE_SIZE", "4096"))
+EMBED_QUANTIZE = os.getenv("EMBED_QUANTIZE", "int8").lower()
+
+# A DISCARD verdict is final as soon as its first tokens arrive
+DISCARD_RE = re.compile(r"^\s*DECISION:\s*DISCARD", re.IGNORECASE)
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def dump_json(data: Any) -> bytes:
+    """Serialize a response body, passing NumPy arrays through natively."""
+    if HAS_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=lambda o: o.tolist()).encode()
+
+
+def load_json(body: bytes) -> Any:
+    """Parse a request body."""
+    return orjson.loads(body) if HAS_ORJSON else json.loads(body)
+
+
+def embeddings_body(embeddings: "np.ndarray", model: str) -> bytearray:
+    """Encode an OpenAI-style embeddings response straight into one buffer."""
+    buf = bytearray(b'{"object":"list","data":[')
+    for i, emb in enumerate(embeddings):
+        if i:
+            buf += b","
+        buf += b'{"object":"embedding","index":%d,"embedding":' % i
+        buf += dump_json(emb)
+        buf += b"}"
+    buf += b'],"model":'
+    buf += dump_json(model)
+    buf += b"}"
+    return buf
+
 
 print("="*70)
 print("Mem0 + GGUF Memory Classifier Server")
@@ -97,6 +159,15 @@ class GGUFServerManager:
         self.process = None
         self.server_url = f"http://localhost:{GGUF_SERVER_PORT}"
         self.model_path = None
+        # Keep-alive connection pool shared by every classification call
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32))
+        # Repeated screen captures often carry the same text; remember verdicts
+        self._classify_cache: "OrderedDict[bytes, tuple[bool, str]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._keepalive_stop = threading.Event()
+        # Tail of llama-server's output, kept for error reports
+        self.log_tail: "deque[str]" = deque(maxlen=200)
         
     def find_llama_server(self) -> Optional[Path]:
         """Find llama-server executable."""
@@ -149,24 +220,39 @@ class GGUFServerManager:
         print(f"       Model: {model_path.name}")
         print(f"       Server: {server_exe}")
         print(f"       Port: {GGUF_SERVER_PORT}")
+        print(f"       Slots: {GGUF_PARALLEL}")
         
         # Build command
         cmd = [
             str(server_exe),
             "-m", str(model_path),
             "--port", str(GGUF_SERVER_PORT),
-            "-c", "4096",           # Context size
+            # Context is split across slots; keep 4096 tokens per slot
+            "-c", str(4096 * GGUF_PARALLEL),
             "-n", "512",            # Max tokens
             "--host", "127.0.0.1",
+            "--mlock",              # Keep weights resident, never paged out
+            # Concurrent classifications share forward passes
+            "--parallel", str(GGUF_PARALLEL),
+            "--cont-batching",
+            "--batch-size", "512",
+            "--ubatch-size", "128",
+            "-ngl", str(GGUF_GPU_LAYERS),
         ]
         
         try:
             self.process = subprocess.Popen(
                 cmd,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
+                stderr=subprocess.STDOUT,
+                text=True,
+                close_fds=False,          # Skip the close-every-fd loop in the child
+                start_new_session=True,   # Ctrl+C goes to us; stop() ends it
             )
+            # The pipe must be drained or llama-server blocks once it fills
+            threading.Thread(
+                target=self._drain_output, args=(self.process.stdout,), daemon=True
+            ).start()
             
             # Wait for server to be ready
             print("[INFO] Waiting for server to start...")
@@ -174,9 +260,11 @@ class GGUFServerManager:
             for i in range(max_wait):
                 time.sleep(1)
                 try:
-                    resp = requests.get(f"{self.server_url}/health", timeout=2)
+                    resp = self.session.get(f"{self.server_url}/health", timeout=2)
                     if resp.status_code == 200:
                         print(f"[OK] GGUF server ready!")
+                        self.warmup()
+                        self._start_keepalive()
                         return True
                 except:
                     pass
@@ -184,6 +272,8 @@ class GGUFServerManager:
                     print(f"       ... ({i}s)")
             
             print("[ERROR] Server failed to start within timeout")
+            for line in list(self.log_tail)[-20:]:
+                print(f"        {line}")
             self.stop()
             return False
             
@@ -191,8 +281,34 @@ class GGUFServerManager:
             print(f"[ERROR] Failed to start server: {e}")
             return False
     
+    def _drain_output(self, stream):
+        """Read server output continuously, keeping only the last lines."""
+        for line in iter(stream.readline, ""):
+            self.log_tail.append(line.rstrip())
+        stream.close()
+    
+    def warmup(self):
+        """Run a 1-token completion so the first real request skips cold start."""
+        self.chat_complete([{"role": "user", "content": "hi"}], max_tokens=1)
+    
+    def _start_keepalive(self):
+        """Periodically ping the server so its weights stay warm."""
+        if GGUF_KEEPALIVE_SECONDS <= 0:
+            return
+        self._keepalive_stop.clear()
+        threading.Thread(target=self._keepalive_loop, daemon=True).start()
+    
+    def _keepalive_loop(self):
+        while not self._keepalive_stop.wait(GGUF_KEEPALIVE_SECONDS):
+            try:
+                self.session.get(f"{self.server_url}/health", timeout=2)
+            except requests.RequestException:
+                continue
+            self.warmup()
+    
     def stop(self):
         """Stop the llama.cpp server."""
+        self._keepalive_stop.set()
         if self.process:
             print("[INFO] Stopping GGUF server...")
             self.process.terminate()
@@ -214,7 +330,7 @@ class GGUFServerManager:
         }
         
         try:
-            resp = requests.post(url, json=payload, timeout=30)
+            resp = self.session.post(url, json=payload, timeout=30)
             resp.raise_for_status()
             data = resp.json()
             return data["choices"][0]["message"]["content"]
@@ -222,11 +338,71 @@ class GGUFServerManager:
             print(f"[ERROR] GGUF chat failed: {e}")
             return ""
     
+    def chat_stream(self, messages: List[Dict[str, str]], max_tokens: int = 512,
+                    stop_when: Optional[re.Pattern] = None) -> str:
+        """
+        Stream a chat completion from the GGUF server.
+        Stops reading (and drops the connection, which aborts generation)
+        once ``stop_when`` matches the text received so far.
+        """
+        url = f"{self.server_url}/v1/chat/completions"
+        
+        payload = {
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": 0.1,
+            "stream": True
+        }
+        
+        text = ""
+        try:
+            with self.session.post(url, json=payload, timeout=30, stream=True) as resp:
+                resp.raise_for_status()
+                for line in resp.iter_lines():
+                    if not line.startswith(b"data: "):
+                        continue
+                    chunk = line[6:]
+                    if chunk == b"[DONE]":
+                        break
+                    for choice in json.loads(chunk).get("choices", []):
+                        text += choice.get("delta", {}).get("content") or ""
+                    if stop_when is not None and stop_when.match(text):
+                        break
+        except Exception as e:
+            print(f"[ERROR] GGUF chat failed: {e}")
+            return ""
+        return text
+    
+    @staticmethod
+    def _cache_key(text: str) -> bytes:
+        """Hash of whitespace-collapsed, casefolded text."""
+        normalized = WHITESPACE_RE.sub(" ", text.casefold()).strip()
+        return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+    
     def classify_memory(self, text: str) -> tuple[bool, str]:
         """
         Classify if text is useful memory.
         Returns: (is_useful, extracted_memory)
         """
+        key = self._cache_key(text)
+        with self._cache_lock:
+            cached = self._classify_cache.get(key)
+            if cached is not None:
+                self._classify_cache.move_to_end(key)
+                return cached
+        
+        result = self._classify_uncached(text)
+        if result is None:
+            return False, ""
+        
+        with self._cache_lock:
+            self._classify_cache[key] = result
+            if len(self._classify_cache) > CLASSIFY_CACHE_SIZE:
+                self._classify_cache.popitem(last=False)
+        return result
+    
+    def _classify_uncached(self, text: str) -> Optional[tuple[bool, str]]:
+        """Ask the GGUF model; None if the server didn't answer."""
         system_prompt = """You are a memory classifier. Your job is to determine if the given text contains useful, memorable information.
 
 Useful memories include:
@@ -250,7 +426,10 @@ MEMORY: (if USEFUL, extract the concise memory to store)"""
             {"role": "user", "content": f"Text to classify:\n{text}"}
         ]
         
-        response = self.chat_complete(messages, max_tokens=256)
+        response = self.chat_stream(messages, max_tokens=256, stop_when=DISCARD_RE)
+        if not response:
+            # Don't cache server failures as DISCARD verdicts
+            return None
         
         # Parse response
         is_useful = "USEFUL" in response.upper() and "DISCARD" not in response.upper()
@@ -273,25 +452,38 @@ gguf_manager = GGUFServerManager()
 # Embedding Model (unchanged)
 # ============================================================================
 
+def _masked_mean_pool(hidden, mask):
+    """Mean-pool token embeddings over the attention mask, then L2-normalize."""
+    # Scale the mask by 1/length up front so the einsum is a single weighted
+    # reduction that reads ``hidden`` once and yields the mean directly.
+    mask_f = mask.to(hidden.dtype)
+    weights = mask_f / mask_f.sum(dim=1, keepdim=True).clamp_min(1e-9)
+    pooled = torch.einsum("bse,bs->be", hidden, weights)
+    return torch.nn.functional.normalize(pooled, p=2, dim=1).float()
+
+
 class LocalEmbedder:
     """Local embedding provider for Mem0."""
     
+    MAX_LENGTH = 8192
+    # Padded tokens per forward pass; inputs are bucketed by length so
+    # short texts are not padded out to the longest one in the request.
+    BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "8192"))
+    
     def __init__(self):
         self.embedding_model = None
         self.embedding_tokenizer = None
         self.device = "cpu"
+        self._pool = _masked_mean_pool
+        # Request handlers run on their own threads; one forward pass at a time
+        self._lock = threading.Lock()
         
-        try:
-            import torch
-            if torch.cuda.is_available():
-                self.device = "cuda"
-        except:
-            pass
+        if torch.cuda.is_available():
+            self.device = "cuda"
     
     def load(self):
         """Load embedding model."""
         from transformers import AutoTokenizer, AutoModel
-        import torch
         
         model_path = MODELS_DIR / "embeddinggemma-300m-f8"
         
@@ -299,45 +491,117 @@ class LocalEmbedder:
             print(f"[ERROR] Embedding model not found at {model_path}")
             return False
         
+        # BF16 keeps FP16's bandwidth with a wider range on Ampere+ GPUs
+        dtype = torch.float16
+        attn_implementation = "sdpa"
+        if self.device == "cuda":
+            if torch.cuda.is_bf16_supported():
+                dtype = torch.bfloat16
+            if importlib.util.find_spec("flash_attn") is not None:
+                attn_implementation = "flash_attention_2"
+        
+        # int8 weights halve the bytes read per matmul on the GPU
+        quantization_config = None
+        if self.device == "cuda" and EMBED_QUANTIZE == "int8":
+            if importlib.util.find_spec("bitsandbytes") is not None:
+                from transformers import BitsAndBytesConfig
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+            else:
+                print("[INFO] bitsandbytes not installed, embedding weights stay unquantized")
+        
         print(f"[INFO] Loading embedding model...")
+        # Rust-backed tokenizer; the Python one tokenizes batches far slower
         self.embedding_tokenizer = AutoTokenizer.from_pretrained(
-            model_path, trust_remote_code=True, local_files_only=True
+            model_path, use_fast=True, trust_remote_code=True, local_files_only=True
         )
+        self.embedding_tokenizer(["x"] * 8, padding=True, return_tensors="pt")
         self.embedding_model = AutoModel.from_pretrained(
             model_path, trust_remote_code=True, local_files_only=True,
-            torch_dtype=torch.float16,
+            torch_dtype=dtype,
+            attn_implementation=attn_implementation,
+            quantization_config=quantization_config,
             device_map="auto"
         )
-        self.embedding_model.to(self.device)
+        if quantization_config is None:
+            # Quantized models are placed by device_map and can't be moved
+            self.embedding_model.to(self.device)
         self.embedding_model.eval()
-        print("[OK] Embedding model loaded")
+        
+        # Compile the forward pass and the pooling tail; fall back to eager
+        # execution if the backend can't handle a graph. Default mode, not
+        # "reduce-overhead": embeds run on whichever handler thread got the
+        # request, CUDA graphs are recorded per thread, and the token-budget
+        # buckets produce an open-ended set of batch shapes to record.
+        try:
+            import torch._dynamo
+            torch._dynamo.config.suppress_errors = True
+            self.embedding_model = torch.compile(self.embedding_model, fullgraph=False)
+            self._pool = torch.compile(_masked_mean_pool)
+        except Exception as e:
+            print(f"[WARN] torch.compile unavailable, using eager mode: {e}")
+        
+        weights = "int8" if quantization_config is not None else dtype
+        print(f"[OK] Embedding model loaded ({weights}, {attn_implementation})")
         return True
     
-    def embed(self, texts: List[str]) -> List[List[float]]:
-        """Generate embeddings."""
-        import torch
-        
+    def _attention_context(self):
+        """Restrict SDPA to the fused flash / memory-efficient kernels on CUDA."""
+        if self.device != "cuda":
+            return contextlib.nullcontext()
+        try:
+            from torch.nn.attention import sdpa_kernel, SDPBackend
+        except ImportError:
+            return contextlib.nullcontext()
+        return sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+    
+    def _length_buckets(self, lengths: List[int]) -> List[List[int]]:
+        """Group input indices by token length so each padded batch fits BATCH_TOKENS."""
+        order = sorted(range(len(lengths)), key=lengths.__getitem__)
+        buckets, current = [], []
+        for idx in order:
+            # Sorted ascending, so the padded width of the batch is lengths[idx]
+            if current and (len(current) + 1) * lengths[idx] > self.BATCH_TOKENS:
+                buckets.append(current)
+                current = []
+            current.append(idx)
+        if current:
+            buckets.append(current)
+        return buckets
+    
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Generate embeddings as a (len(texts), dims) float32 array."""
+        with self._lock:
+            return self._embed(texts)
+    
+    def _embed(self, texts: List[str]) -> np.ndarray:
         if self.embedding_model is None:
             if not self.load():
-                return [[0.0] * 768] * len(texts)
+                return np.zeros((len(texts), 768), dtype=np.float32)
         
-        embeddings = []
-        batch_size = 8
+        if not texts:
+            return np.zeros((0, 768), dtype=np.float32)
         
-        with torch.no_grad():
-            for i in range(0, len(texts), batch_size):
-                batch = texts[i:i + batch_size]
-                encoded = self.embedding_tokenizer(
-                    batch, padding=True, truncation=True,
-                    return_tensors="pt", max_length=8192
+        tokenized = self.embedding_tokenizer(
+            texts, truncation=True, max_length=self.MAX_LENGTH
+        )
+        lengths = [len(ids) for ids in tokenized["input_ids"]]
+        embeddings = None
+        
+        # Each bucket is padded only to its own longest text, so short inputs
+        # never pay for MAX_LENGTH-wide attention.
+        with torch.inference_mode(), self._attention_context():
+            for bucket in self._length_buckets(lengths):
+                encoded = self.embedding_tokenizer.pad(
+                    {k: [v[i] for i in bucket] for k, v in tokenized.items()},
+                    return_tensors="pt"
                 )
                 encoded = {k: v.to(self.device) for k, v in encoded.items()}
                 
                 output = self.embedding_model(**encoded)
-                mask = encoded["attention_mask"].unsqueeze(-1).float()
-                embeddings_batch = (output[0] * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
-                embeddings_batch = torch.nn.functional.normalize(embeddings_batch, p=2, dim=1)
-                embeddings.extend(embeddings_batch.cpu().numpy().tolist())
+                embeddings_batch = self._pool(output[0], encoded["attention_mask"]).cpu().numpy()
+                if embeddings is None:
+                    embeddings = np.empty((len(texts), embeddings_batch.shape[1]), dtype=np.float32)
+                embeddings[bucket] = embeddings_batch
         
         return embeddings
 
@@ -457,6 +721,10 @@ if HAS_MEM0:
     
     print(f"[OK] Found GGUF model: {model_path}")
     
+    # llama-server runs in its own session, so Ctrl+C never reaches it; stop
+    # it on every exit path (errors, sys.exit, SIGTERM), not just Ctrl+C
+    atexit.register(gguf_manager.stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     if not gguf_manager.start(model_path):
         print("[ERROR] Failed to start GGUF server")
         sys.exit(1)
@@ -511,6 +779,9 @@ class GGUFMem0Handler(BaseHTTPRequestHandler):
         "http://localhost:7345",
         "chrome-extension://*",
     ]
+    # Split once: exact origins for a set lookup, "/*" entries as prefixes
+    _EXACT_ORIGINS = frozenset(o for o in ALLOWED_ORIGINS if not o.endswith('/*'))
+    _ORIGIN_PREFIXES = tuple(o[:-1] for o in ALLOWED_ORIGINS if o.endswith('/*'))
     
     def log_message(self, format, *args):
         print(f"[{datetime.now().strftime('%H:%M:%S')}] {format % args}")
@@ -519,27 +790,24 @@ class GGUFMem0Handler(BaseHTTPRequestHandler):
         return self.headers.get('Origin', '')
     
     def _is_allowed_origin(self, origin):
-        if not origin:
-            return True
-        for allowed in self.ALLOWED_ORIGINS:
-            if allowed.endswith('/*'):
-                if origin.startswith(allowed[:-1]):
-                    return True
-            elif origin == allowed:
-                return True
-        return False
+        return (not origin or origin in self._EXACT_ORIGINS
+                or origin.startswith(self._ORIGIN_PREFIXES))
     
     def send_json_response(self, data: dict, status: int = 200):
+        self.send_body(dump_json(data), status)
+    
+    def send_body(self, body: bytes, status: int = 200, content_type: str = "application/json"):
         origin = self._get_origin()
         self.send_response(status)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
         if self._is_allowed_origin(origin):
             self.send_header("Access-Control-Allow-Origin", origin if origin else "http://localhost:3000")
             self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
             self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
             self.send_header("Access-Control-Allow-Credentials", "true")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
     
     def do_OPTIONS(self):
         origin = self._get_origin()
@@ -584,8 +852,8 @@ class GGUFMem0Handler(BaseHTTPRequestHandler):
         path = parsed.path
         
         content_length = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(content_length).decode()
-        data = json.loads(body) if body else {}
+        body = self.rfile.read(content_length)
+        data = load_json(body) if body else {}
         
         # Embeddings endpoint
         if path == "/v1/embeddings":
@@ -596,15 +864,14 @@ class GGUFMem0Handler(BaseHTTPRequestHandler):
                 
                 embeddings = embedder.embed(input_texts)
                 
-                response = {
-                    "object": "list",
-                    "data": [
-                        {"object": "embedding", "embedding": emb, "index": i}
-                        for i, emb in enumerate(embeddings)
-                    ],
-                    "model": "embedding-gemma",
-                }
-                self.send_json_response(response)
+                if "application/octet-stream" in self.headers.get("Accept", ""):
+                    # Binary form: uint32 count, uint32 dims, then row-major
+                    # little-endian float32 (np.frombuffer-ready)
+                    arr = np.ascontiguousarray(embeddings, dtype="<f4")
+                    body = struct.pack("<II", *arr.shape) + arr.tobytes()
+                    self.send_body(body, content_type="application/octet-stream")
+                else:
+                    self.send_body(embeddings_body(embeddings, "embedding-gemma"))
             except Exception as e:
                 print(f"[ERROR] Embeddings failed: {e}")
                 self.send_json_response({"error": str(e)}, 500)
@@ -684,7 +951,9 @@ def main():
     print("Press Ctrl+C to stop")
     print()
     
-    server = HTTPServer((HOST, PORT), GGUFMem0Handler)
+    # One thread per request so health checks and searches aren't queued
+    # behind a classification or embedding call.
+    server = ThreadingHTTPServer((HOST, PORT), GGUFMem0Handler)
     
     try:
         server.serve_forever()
@@ -18,8 +18,9 @@ import sys
 import json
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 
 try:
@@ -28,10 +29,24 @@ try:
 except ImportError:
     pass
 
+# orjson is optional: faster JSON encode/decode on every request
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    orjson = None
+    HAS_ORJSON = False
+
 # Config
 HOST = os.getenv("MEM0_HOST", "localhost")
 PORT = int(os.getenv("MEM0_PORT", "8000"))
 LM_STUDIO_URL = os.getenv("LM_STUDIO_URL", "http://localhost:1234/v1").rstrip('/')
+# Qdrant server URL; when unset vectors live in embedded ./qdrant_storage
+QDRANT_URL = os.getenv("QDRANT_URL", "")
+
+# Pooled keep-alive connections to LM Studio
+LM_SESSION = requests.Session()
+LM_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=0))
 
 print("="*60)
 print("Mem0 Server + LM Studio (LFM2-350M)")
@@ -39,7 +54,7 @@ print("="*60)
 
 # Check LM Studio
 try:
-    resp = requests.get(f"{LM_STUDIO_URL}/models", timeout=5)
+    resp = LM_SESSION.get(f"{LM_STUDIO_URL}/models", timeout=5)
     models = resp.json().get('data', [])
     print(f"[OK] LM Studio connected: {len(models)} model(s)")
     for m in models[:3]:
@@ -59,6 +74,25 @@ except ImportError:
     print("[ERROR] pip install mem0ai")
     sys.exit(1)
 
+# Mem0 builds its own OpenAI clients; have them all share one pooled
+# httpx client so every add/search reuses warm connections to LM Studio
+try:
+    import httpx
+    import openai
+    
+    LM_HTTP_CLIENT = httpx.Client(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=16)
+    )
+    _original_openai_init = openai.OpenAI.__init__
+    
+    def _pooled_openai_init(self, *args, **kwargs):
+        kwargs.setdefault("http_client", LM_HTTP_CLIENT)
+        _original_openai_init(self, *args, **kwargs)
+    
+    openai.OpenAI.__init__ = _pooled_openai_init
+except ImportError:
+    pass
+
 # Configure Mem0 to use LM Studio
 config = {
     "vector_store": {
@@ -66,7 +100,7 @@ config = {
         "config": {
             "collection_name": "lfm2_memories",
             "embedding_model_dims": 768,
-            "path": "./qdrant_storage",
+            **({"url": QDRANT_URL} if QDRANT_URL else {"path": "./qdrant_storage"}),
         }
     },
     "llm": {
@@ -84,11 +118,28 @@ config = {
 try:
     memory = Memory.from_config(config_dict=config)
     print("[OK] Mem0 ready with LFM2-350M")
-    print()
 except Exception as e:
     print(f"[ERROR] {e}")
     sys.exit(1)
 
+# Mem0's Qdrant config has no quantization/HNSW options, so tune the
+# collection directly: int8 vectors kept in RAM, HNSW graph on disk.
+# Embedded (path) mode does brute-force search and ignores these.
+if QDRANT_URL:
+    try:
+        from qdrant_client import models as qm
+        memory.vector_store.client.update_collection(
+            collection_name=memory.vector_store.collection_name,
+            quantization_config=qm.ScalarQuantization(
+                scalar=qm.ScalarQuantizationConfig(type=qm.ScalarType.INT8, always_ram=True)
+            ),
+            hnsw_config=qm.HnswConfigDiff(on_disk=True, m=16, ef_construct=128),
+        )
+        print("[OK] Qdrant collection uses int8 scalar quantization")
+    except Exception as e:
+        print(f"[WARN] Could not enable Qdrant quantization: {e}")
+print()
+
 
 class Handler(BaseHTTPRequestHandler):
     # Allowed origins for CORS
@@ -98,6 +149,9 @@ class Handler(BaseHTTPRequestHandler):
         "http://localhost:7345",
         "chrome-extension://*",
     ]
+    # Split once: exact origins for a set lookup, "/*" entries as prefixes
+    _EXACT_ORIGINS = frozenset(o for o in ALLOWED_ORIGINS if not o.endswith('/*'))
+    _ORIGIN_PREFIXES = tuple(o[:-1] for o in ALLOWED_ORIGINS if o.endswith('/*'))
     
     def log_message(self, fmt, *args):
         print(f"[{datetime.now().strftime('%H:%M:%S')}] {fmt % args}")
@@ -106,15 +160,8 @@ class Handler(BaseHTTPRequestHandler):
         return self.headers.get('Origin', '')
     
     def _is_allowed_origin(self, origin):
-        if not origin:
-            return True
-        for allowed in self.ALLOWED_ORIGINS:
-            if allowed.endswith('/*'):
-                if origin.startswith(allowed[:-1]):
-                    return True
-            elif origin == allowed:
-                return True
-        return False
+        return (not origin or origin in self._EXACT_ORIGINS
+                or origin.startswith(self._ORIGIN_PREFIXES))
     
     def json(self, data, status=200):
         origin = self._get_origin()
@@ -126,7 +173,7 @@ class Handler(BaseHTTPRequestHandler):
             self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
             self.send_header("Access-Control-Allow-Credentials", "true")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(orjson.dumps(data) if HAS_ORJSON else json.dumps(data).encode())
     
     def do_OPTIONS(self):
         origin = self._get_origin()
@@ -151,6 +198,7 @@ class Handler(BaseHTTPRequestHandler):
                 results = memory.get_all(
                     user_id=q.get("user_id", ["default"])[0],
                     limit=int(q.get("limit", ["10"])[0])
+                )
                 self.json(results if isinstance(results, list) else [])
             except Exception as e:
                 self.json({"error": str(e)}, 500)
@@ -161,8 +209,8 @@ class Handler(BaseHTTPRequestHandler):
     def do_POST(self):
         p = urlparse(self.path)
         n = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(n).decode()
-        data = json.loads(body) if body else {}
+        body = self.rfile.read(n)
+        data = (orjson.loads(body) if HAS_ORJSON else json.loads(body)) if body else {}
         
         # Add memory (LFM2 extracts important facts)
         if p.path == "/v1/memories/":
@@ -210,7 +258,8 @@ print()
 print("Press Ctrl+C to stop")
 print()
 
-server = HTTPServer((HOST, PORT), Handler)
+# Threaded so a slow LM Studio extraction doesn't block health/search calls
+server = ThreadingHTTPServer((HOST, PORT), Handler)
 try:
     server.serve_forever()
 except KeyboardInterrupt:
@@ -21,11 +21,27 @@ import sys
 import json
 import time
 import io
+import queue
 import base64
+import hashlib
+import threading
 import subprocess
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from importlib.metadata import version, PackageNotFoundError
 from pathlib import Path
 from typing import Optional, List, Dict, Any
 
+from _embed_shared import DiskEmbeddingCache
+
+# orjson is optional: faster JSON and native NumPy array serialization
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    orjson = None
+    HAS_ORJSON = False
+
 # ============================================================================
 # Configuration
 # ============================================================================
@@ -40,14 +56,49 @@ EMBEDDING_MODEL = {
     "local_path": MODELS_DIR / "nomic-embed-text-v1.5",
     "dims": 768,
     "max_length": 2048,
+    # Inputs are padded up to the smallest of these that fits, so the
+    # model sees a handful of stable shapes instead of one per request
+    "length_buckets": (64, 128, 256, 512, 2048),
+    # Texts per forward pass, also the cap for cross-request coalescing
+    "batch_size": int(os.getenv("EMBED_BATCH_SIZE", "32")),
+    # How long the batcher waits for more requests to join a batch
+    "batch_wait_ms": float(os.getenv("EMBED_BATCH_WAIT_MS", "5")),
+    # Vectors kept in the in-memory LRU, keyed by text hash
+    "cache_size": int(os.getenv("EMBED_CACHE_SIZE", "10000")),
+    # "torch", or "onnx" to serve an ONNX export through ONNX Runtime
+    "backend": os.getenv("EMBED_BACKEND", "torch").lower(),
+    "onnx_provider": os.getenv("EMBED_ONNX_PROVIDER", "CPUExecutionProvider"),
+    # fp16 vectors persisted across restarts; empty string disables
+    "disk_cache_dir": os.getenv("EMBED_DISK_CACHE_DIR", str(MODELS_DIR / "embedding-cache")),
 }
 
 VISION_MODEL = {
     "name": "LiquidAI/LFM-2-Vision-450M",
     "local_path": MODELS_DIR / "lfm-2-vision-450m",
     "max_length": 4096,
+    # OpenAI-compatible inference server to hand chat requests to instead of
+    # running generate() in-process, e.g. the /v1 base of
+    #   vllm serve LiquidAI/LFM-2-Vision-450M --dtype bfloat16 --enable-prefix-caching
+    "backend_url": os.getenv("VISION_BACKEND_URL", "").rstrip("/"),
+    "backend_timeout": float(os.getenv("VISION_BACKEND_TIMEOUT", "120")),
+    # KV caches kept for repeated text prefixes (earlier messages of a chat)
+    "prefix_cache_size": int(os.getenv("VISION_PREFIX_CACHE_SIZE", "8")),
+    # Static KV cache + compiled forward so decode steps replay as CUDA graphs
+    "cuda_graphs": os.getenv("VISION_CUDA_GRAPHS", "0") == "1",
 }
 
+
+def dump_json(data: Any) -> bytes:
+    """Serialize a response body, passing NumPy arrays through natively."""
+    if HAS_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=lambda o: o.tolist()).encode()
+
+
+def load_json(body: bytes) -> Any:
+    """Parse a request body."""
+    return orjson.loads(body) if HAS_ORJSON else json.loads(body)
+
 # ============================================================================
 # Dependency Management
 # ============================================================================
@@ -68,9 +119,10 @@ def check_and_install_dependencies():
     missing = []
     for package in REQUIRED_PACKAGES:
         pkg_name = package.split(">=")[0].split("==")[0]
+        # Reads installed dist-info only; importing torch here would cost seconds
         try:
-            __import__(pkg_name.replace("-", "_"))
-        except ImportError:
+            version(pkg_name)
+        except PackageNotFoundError:
             missing.append(package)
     
     if missing:
@@ -91,6 +143,26 @@ def check_and_install_dependencies():
 # Model Management
 # ============================================================================
 
+# Image decoding is CPU-bound and PIL releases the GIL while decoding
+IMG_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="img-decode")
+
+
+def _decode_b64(image_url: str):
+    """Decode a base64 data URL into an RGB PIL image."""
+    from PIL import Image
+    image_bytes = base64.b64decode(image_url.partition(",")[2])
+    return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+
+
+def pool_and_normalize(token_embeddings, attention_mask):
+    """Mean-pool token embeddings over the attention mask, then L2-normalize."""
+    import torch
+    mask = attention_mask.unsqueeze(-1).to(torch.float32)
+    summed = (token_embeddings * mask).sum(dim=1)
+    counts = mask.sum(dim=1).clamp_min(1e-9)
+    return torch.nn.functional.normalize(summed / counts, p=2, dim=1)
+
+
 class ModelManager:
     """Manages downloading and loading of local models."""
     
@@ -101,6 +173,24 @@ class ModelManager:
         self.vision_processor = None
         self.vision_tokenizer = None
         self.device = "cpu"
+        # Requests arrive on many threads; the models run one call at a time
+        self.inference_lock = threading.Lock()
+        self._pool = pool_and_normalize
+        self._vision_session = None
+        # Prompt-prefix KV cache for text-only chats, guarded by inference_lock
+        self._prefix_cache: "OrderedDict[bytes, Any]" = OrderedDict()
+        self._vision_graphs = False
+        # Every local vision generate() runs on this one thread: CUDA graphs
+        # belong to the thread that recorded them, and inference_lock
+        # already allows only one generation at a time
+        self._vision_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vision")
+        # Embedding LRU, cleared whenever the embedding model is (re)loaded
+        self._embedding_cache: "OrderedDict[bytes, Any]" = OrderedDict()
+        self._cache_lock = threading.RLock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.disk_cache: Optional[DiskEmbeddingCache] = None
+        self.disk_hits = 0
         
         # Try to use CUDA if available
         try:
@@ -152,8 +242,41 @@ class ModelManager:
         if not local_path.exists():
             self.download_embedding_model()
         
+        with self._cache_lock:
+            self._embedding_cache.clear()
+            if self.disk_cache is None and EMBEDDING_MODEL["disk_cache_dir"]:
+                # One cache per model; vectors from another model are not comparable
+                cache_dir = Path(EMBEDDING_MODEL["disk_cache_dir"]) / EMBEDDING_MODEL["name"].replace("/", "--")
+                try:
+                    self.disk_cache = DiskEmbeddingCache(cache_dir, EMBEDDING_MODEL["dims"])
+                    print(f"[OK] Embedding disk cache: {self.disk_cache.size} vectors in {cache_dir}")
+                except Exception as e:
+                    print(f"[WARN] Embedding disk cache disabled: {e}")
+        
+        # Fuse the pooling tail into one kernel; falls back to eager on errors.
+        # Default mode, not "reduce-overhead": batches arrive in arbitrary
+        # shapes, and CUDA graphs recorded by the warmup thread would not be
+        # reused by the batcher thread anyway.
+        try:
+            import torch._dynamo
+            torch._dynamo.config.suppress_errors = True
+            self._pool = torch.compile(pool_and_normalize)
+        except Exception as e:
+            print(f"[WARN] torch.compile unavailable, pooling runs eagerly: {e}")
+        
         print(f"[INFO] Loading embedding model from {local_path}...")
         
+        if EMBEDDING_MODEL["backend"] == "onnx":
+            try:
+                self.embedding_tokenizer = AutoTokenizer.from_pretrained(
+                    local_path, trust_remote_code=True, local_files_only=True
+                )
+                self.embedding_model = self._load_onnx_embedding_model(local_path)
+                print(f"[OK] Embedding model loaded with ONNX Runtime ({EMBEDDING_MODEL['onnx_provider']})")
+                return
+            except ImportError:
+                print("[WARN] optimum[onnxruntime] not installed, using the PyTorch backend")
+        
         try:
             self.embedding_tokenizer = AutoTokenizer.from_pretrained(
                 local_path, 
@@ -165,8 +288,7 @@ class ModelManager:
                 trust_remote_code=True,
                 local_files_only=True
             )
-            self.embedding_model.to(self.device)
-            self.embedding_model.eval()
+            self.embedding_model = self._optimize_embedding_model(self.embedding_model)
             
             print(f"[OK] Embedding model loaded successfully")
         except Exception as e:
@@ -180,8 +302,43 @@ class ModelManager:
             self.embedding_model = AutoModel.from_pretrained(
                 local_path, trust_remote_code=True, local_files_only=True
             )
-            self.embedding_model.to(self.device)
-            self.embedding_model.eval()
+            self.embedding_model = self._optimize_embedding_model(self.embedding_model)
+    
+    def _half_dtype(self):
+        """BF16 where the GPU supports it, FP16 otherwise."""
+        import torch
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    
+    def _optimize_embedding_model(self, model):
+        """Put the embedding model on its device in a narrower precision."""
+        import torch
+        
+        model.eval()
+        if self.device == "cpu":
+            # The forward pass is memory-bound on CPU; int8 Linear weights
+            # quarter the bytes read per matmul
+            return torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model.to(self.device, dtype=self._half_dtype())
+    
+    def _load_onnx_embedding_model(self, local_path: Path):
+        """Export the embedding model to ONNX once, then load it in ONNX Runtime."""
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        
+        onnx_path = local_path / "onnx"
+        if not (onnx_path / "model.onnx").exists():
+            from optimum.exporters.onnx import main_export
+            print(f"[INFO] Exporting embedding model to ONNX at {onnx_path}...")
+            main_export(
+                model_name_or_path=str(local_path),
+                output=onnx_path,
+                task="feature-extraction",
+                trust_remote_code=True,
+            )
+        return ORTModelForFeatureExtraction.from_pretrained(
+            onnx_path, provider=EMBEDDING_MODEL["onnx_provider"]
+        )
     
     def download_vision_model(self, force: bool = False):
         """Download the LFM vision model."""
@@ -239,10 +396,12 @@ class ModelManager:
                 local_path,
                 trust_remote_code=True,
                 local_files_only=True,
-                torch_dtype="auto"
+                torch_dtype=self._half_dtype() if self.device == "cuda" else "auto"
             )
             self.vision_model.to(self.device)
             self.vision_model.eval()
+            self._prefix_cache.clear()
+            self._enable_vision_cuda_graphs()
             
             print(f"[OK] Vision model loaded successfully")
         except Exception as e:
@@ -253,13 +412,107 @@ class ModelManager:
                 local_path, trust_remote_code=True, local_files_only=True
             )
             self.vision_model = AutoModelForVision2Seq.from_pretrained(
-                local_path, trust_remote_code=True, local_files_only=True
+                local_path, trust_remote_code=True, local_files_only=True,
+                torch_dtype=self._half_dtype() if self.device == "cuda" else "auto"
             )
             self.vision_model.to(self.device)
             self.vision_model.eval()
+            self._prefix_cache.clear()
+            self._enable_vision_cuda_graphs()
+    
+    def _enable_vision_cuda_graphs(self):
+        """Capture vision decode steps as CUDA graphs (VISION_CUDA_GRAPHS=1).
+        
+        With a static KV cache every decode step has the same shapes, so a
+        forward compiled with mode="reduce-overhead" is recorded once as a
+        CUDA graph and replayed per token instead of launching each kernel.
+        Graphs are per thread, which is why vision_chat generates on
+        _vision_worker.
+        """
+        import torch
+        
+        self._vision_graphs = False
+        if not VISION_MODEL["cuda_graphs"] or self.device != "cuda":
+            return
+        try:
+            import torch._dynamo
+            torch._dynamo.config.suppress_errors = True
+            self.vision_model.generation_config.cache_implementation = "static"
+            self.vision_model.forward = torch.compile(self.vision_model.forward, mode="reduce-overhead")
+            self._vision_graphs = True
+            print("[OK] Vision decode uses a static cache with CUDA graphs")
+        except Exception as e:
+            print(f"[WARN] CUDA graphs unavailable for vision model: {e}")
+    
+    def generate_embeddings(self, texts: List[str]):
+        """Generate embeddings for given texts, reusing cached vectors.
+        
+        Returns a (len(texts), dims) float32 NumPy array.
+        """
+        import numpy as np
+        
+        keys = [hashlib.blake2b(t.encode(), digest_size=16).digest() for t in texts]
+        embeddings: List[Any] = [None] * len(texts)
+        misses = []
+        
+        with self._cache_lock:
+            for i, key in enumerate(keys):
+                cached = self._embedding_cache.get(key)
+                if cached is None:
+                    misses.append(i)
+                else:
+                    self._embedding_cache.move_to_end(key)
+                    embeddings[i] = cached
+            self.cache_hits += len(texts) - len(misses)
+            self.cache_misses += len(misses)
+        
+        if misses and self.disk_cache is not None:
+            with self._cache_lock:
+                stored = self.disk_cache.get_many([keys[i] for i in misses])
+                for i in misses:
+                    emb = stored.get(keys[i])
+                    if emb is not None:
+                        embeddings[i] = emb
+                        self._embedding_cache[keys[i]] = emb
+                self.disk_hits += len(stored)
+                self._trim_embedding_cache()
+            misses = [i for i in misses if embeddings[i] is None]
+        
+        if misses:
+            computed = self._compute_embeddings([texts[i] for i in misses])
+            with self._cache_lock:
+                for i, emb in zip(misses, computed):
+                    embeddings[i] = emb
+                    self._embedding_cache[keys[i]] = emb
+                self._trim_embedding_cache()
+                if self.disk_cache is not None:
+                    self.disk_cache.put_many([(keys[i], embeddings[i]) for i in misses])
+        
+        if not embeddings:
+            return np.zeros((0, EMBEDDING_MODEL["dims"]), dtype=np.float32)
+        return np.stack(embeddings)
     
-    def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Generate embeddings for given texts."""
+    def _trim_embedding_cache(self):
+        while len(self._embedding_cache) > EMBEDDING_MODEL["cache_size"]:
+            self._embedding_cache.popitem(last=False)
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for the embedding cache."""
+        with self._cache_lock:
+            total = self.cache_hits + self.cache_misses
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "hit_rate": self.cache_hits / total if total else 0.0,
+                "size": len(self._embedding_cache),
+                "max_size": EMBEDDING_MODEL["cache_size"],
+                "disk_hits": self.disk_hits,
+                "disk_size": self.disk_cache.size if self.disk_cache is not None else 0,
+            }
+    
+    def _compute_embeddings(self, texts: List[str]):
+        """Run the embedding model over texts into a float32 NumPy array."""
+        import numpy as np
         import torch
         
         if self.embedding_model is None:
@@ -269,53 +522,137 @@ class ModelManager:
         # For now, treat all as documents
         texts = [f"search_document: {t}" for t in texts]
         
-        embeddings = []
-        batch_size = 8  # Process in batches to avoid OOM
+        batch_size = EMBEDDING_MODEL["batch_size"]  # Process in batches to avoid OOM
+        tokenized = self.embedding_tokenizer(
+            texts, truncation=True, max_length=EMBEDDING_MODEL["max_length"]
+        )
+        embeddings = np.empty((len(texts), EMBEDDING_MODEL["dims"]), dtype=np.float32)
         
-        with torch.no_grad():
-            for i in range(0, len(texts), batch_size):
-                batch = texts[i:i + batch_size]
-                
-                # Tokenize
-                encoded = self.embedding_tokenizer(
-                    batch,
-                    padding=True,
-                    truncation=True,
-                    return_tensors="pt",
-                    max_length=EMBEDDING_MODEL["max_length"]
-                )
-                encoded = {k: v.to(self.device) for k, v in encoded.items()}
-                
-                # Generate embeddings
-                model_output = self.embedding_model(**encoded)
-                
-                # Mean pooling
-                attention_mask = encoded["attention_mask"]
-                token_embeddings = model_output[0]
-                input_mask_expanded = attention_mask.unsqueeze(-1).float()
-                sum_embeddings = (token_embeddings * input_mask_expanded).sum(dim=1)
-                embeddings_batch = sum_embeddings / input_mask_expanded.sum(dim=1).clamp(min=1e-9)
-                
-                # Normalize
-                embeddings_batch = torch.nn.functional.normalize(embeddings_batch, p=2, dim=1)
-                
-                embeddings.extend(embeddings_batch.cpu().numpy().tolist())
+        with self.inference_lock, torch.inference_mode():
+            for bucket_len, indices in self._length_buckets(tokenized["input_ids"]):
+                for i in range(0, len(indices), batch_size):
+                    batch = indices[i:i + batch_size]
+                    
+                    # Pad to the bucket size rather than the batch's longest text
+                    encoded = self.embedding_tokenizer.pad(
+                        {k: [v[j] for j in batch] for k, v in tokenized.items()},
+                        padding="max_length",
+                        max_length=bucket_len,
+                        return_tensors="pt"
+                    )
+                    # ONNX Runtime sessions take CPU tensors even when CUDA is present
+                    encoded = {k: v.to(self.embedding_model.device) for k, v in encoded.items()}
+                    
+                    # Generate embeddings
+                    model_output = self.embedding_model(**encoded)
+                    
+                    # Mean pooling + normalize
+                    embeddings_batch = self._pool(model_output[0], encoded["attention_mask"])
+                    
+                    embeddings[batch] = embeddings_batch.float().cpu().numpy()
         
         return embeddings
     
-    def vision_chat(self, messages: List[Dict[str, Any]]) -> str:
+    @staticmethod
+    def _length_buckets(input_ids: List[List[int]]) -> List[tuple]:
+        """Group text indices by the smallest length bucket that fits them."""
+        buckets: Dict[int, List[int]] = {}
+        sizes = EMBEDDING_MODEL["length_buckets"]
+        for i, ids in enumerate(input_ids):
+            bucket_len = next((size for size in sizes if len(ids) <= size), sizes[-1])
+            buckets.setdefault(bucket_len, []).append(i)
+        return sorted(buckets.items())
+    
+    def _remote_vision_chat(self, messages: List[Dict[str, Any]]) -> str:
+        """Forward a chat request to the external vision inference server."""
+        response = self._post_vision_backend(messages, stream=False)
+        return load_json(response.content)["choices"][0]["message"]["content"]
+    
+    def _remote_vision_chat_stream(self, messages: List[Dict[str, Any]]):
+        """Yield reply text pieces streamed by the external inference server."""
+        response = self._post_vision_backend(messages, stream=True)
+        with response:
+            for line in response.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == b"[DONE]":
+                    break
+                for choice in load_json(payload).get("choices") or ():
+                    piece = (choice.get("delta") or {}).get("content")
+                    if piece:
+                        yield piece
+    
+    def _post_vision_backend(self, messages: List[Dict[str, Any]], stream: bool):
+        if self._vision_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._vision_session = session
+        
+        response = self._vision_session.post(
+            f"{VISION_MODEL['backend_url']}/chat/completions",
+            json={
+                "model": VISION_MODEL["name"],
+                "messages": messages,
+                "max_tokens": 512,
+                "temperature": 0.7,
+                "top_p": 0.9,
+                "stream": stream,
+            },
+            timeout=VISION_MODEL["backend_timeout"],
+            stream=stream,
+        )
+        response.raise_for_status()
+        return response
+    
+    def vision_chat_stream(self, messages: List[Dict[str, Any]]):
+        """Chat with the vision model, yielding text as it is generated."""
+        if VISION_MODEL["backend_url"]:
+            yield from self._remote_vision_chat_stream(messages)
+            return
+        
+        from transformers import TextIteratorStreamer
+        
+        if self.vision_model is None:
+            self.load_vision_model()
+        
+        tokenizer = getattr(self.vision_processor, "tokenizer", self.vision_processor)
+        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        
+        def run():
+            try:
+                self.vision_chat(messages, streamer=streamer)
+            except Exception as e:
+                print(f"[ERROR] Streaming generation failed: {e}")
+                # Unblock the consumer; generate() only ends the stream on success
+                streamer.end()
+        
+        threading.Thread(target=run, daemon=True).start()
+        yield from streamer
+    
+    def vision_chat(self, messages: List[Dict[str, Any]], streamer=None) -> str:
         """Chat with the vision model."""
+        # The inference server batches concurrent requests and reuses KV cache
+        if VISION_MODEL["backend_url"]:
+            return self._remote_vision_chat(messages)
+        
         import torch
-        from PIL import Image
         
         if self.vision_model is None:
             self.load_vision_model()
         
         # Extract images and text from messages
-        images = []
+        image_urls = []
         text_parts = []
         
-        for msg in messages:
+        prefix_parts = 0
+        for i, msg in enumerate(messages):
+            if i == len(messages) - 1:
+                prefix_parts = len(text_parts)
             content = msg.get("content", "")
             if isinstance(content, list):
                 for item in content:
@@ -323,16 +660,17 @@ class ModelManager:
                         image_url = item.get("image_url", {}).get("url", "")
                         if image_url.startswith("data:image"):
                             # Base64 encoded image
-                            image_data = image_url.split(",")[1]
-                            image_bytes = base64.b64decode(image_data)
-                            image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-                            images.append(image)
+                            image_urls.append(image_url)
                     elif item.get("type") == "text":
                         text_parts.append(item.get("text", ""))
             else:
                 text_parts.append(content)
         
         text = " ".join(text_parts)
+        if len(image_urls) > 1:
+            images = list(IMG_POOL.map(_decode_b64, image_urls))
+        else:
+            images = [_decode_b64(url) for url in image_urls]
         
         # Process inputs
         if images:
@@ -347,43 +685,165 @@ class ModelManager:
                 return_tensors="pt"
             )
         
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        # Pixel values must match the model's (possibly half) precision
+        dtype = self.vision_model.dtype
+        inputs = {
+            k: v.to(self.device, dtype=dtype) if v.is_floating_point() else v.to(self.device)
+            for k, v in inputs.items()
+        }
         
         # Generate response
-        with torch.no_grad():
-            outputs = self.vision_model.generate(
-                **inputs,
-                max_new_tokens=512,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.9,
-            )
+        def generate():
+            with self.inference_lock, torch.inference_mode():
+                past_key_values = None
+                # A static cache can't be seeded from a cached dynamic prefix
+                if not images and prefix_parts and not self._vision_graphs:
+                    past_key_values = self._prefix_kv(
+                        " ".join(text_parts[:prefix_parts]), inputs["input_ids"]
+                    )
+                return self.vision_model.generate(
+                    **inputs,
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    streamer=streamer,
+                    max_new_tokens=512,
+                    do_sample=True,
+                    temperature=0.7,
+                    top_p=0.9,
+                )
+        
+        outputs = self._vision_worker.submit(generate).result()
         
         response = self.vision_processor.decode(outputs[0], skip_special_tokens=True)
         return response
+    
+    def _prefix_kv(self, prefix_text: str, input_ids):
+        """Return a private copy of the cached KV for the prompt's prefix.
+        
+        Earlier messages of a conversation (system prompt, history) are
+        resent with every turn; their KV is computed once and reused so
+        generate() only prefills the new suffix. Call with inference_lock held.
+        """
+        import copy
+        
+        if VISION_MODEL["prefix_cache_size"] <= 0:
+            return None
+        
+        prefix_ids = self.vision_processor(
+            text=prefix_text, return_tensors="pt"
+        )["input_ids"].to(self.device)
+        n = prefix_ids.shape[1]
+        # Only usable if it tokenizes to a strict prefix of the full prompt
+        if n >= input_ids.shape[1] or not input_ids[0, :n].equal(prefix_ids[0]):
+            return None
+        
+        key = hashlib.blake2b(prefix_ids.cpu().numpy().tobytes(), digest_size=16).digest()
+        cached = self._prefix_cache.get(key)
+        if cached is None:
+            try:
+                cached = self.vision_model(input_ids=prefix_ids, use_cache=True).past_key_values
+            except Exception as e:
+                # e.g. out of memory: drop what we hold and prefill normally
+                print(f"[WARN] Prefix prefill failed, clearing prefix cache: {e}")
+                self._prefix_cache.clear()
+                return None
+            self._prefix_cache[key] = cached
+            while len(self._prefix_cache) > VISION_MODEL["prefix_cache_size"]:
+                self._prefix_cache.popitem(last=False)
+        else:
+            self._prefix_cache.move_to_end(key)
+        # generate() extends the cache in place
+        return copy.deepcopy(cached)
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent embedding requests into shared forward passes."""
+    
+    def __init__(self, manager: ModelManager,
+                 max_batch: int = EMBEDDING_MODEL["batch_size"],
+                 max_wait_ms: float = EMBEDDING_MODEL["batch_wait_ms"]):
+        self.manager = manager
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[tuple[List[str], Future]]" = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def submit(self, texts: List[str]):
+        """Queue texts for embedding and block until their vectors are ready."""
+        future: Future = Future()
+        self._queue.put((texts, future))
+        return future.result()
+    
+    def _collect(self) -> List[tuple]:
+        """Wait for one request, then gather more until the batch is full or the window closes."""
+        pending = [self._queue.get()]
+        count = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item)
+            count += len(item[0])
+        return pending
+    
+    def _run(self):
+        while True:
+            pending = self._collect()
+            texts = [text for batch, _ in pending for text in batch]
+            try:
+                embeddings = self.manager.generate_embeddings(texts)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            
+            # Hand each caller back its own slice, in submission order
+            offset = 0
+            for batch, future in pending:
+                future.set_result(embeddings[offset:offset + len(batch)])
+                offset += len(batch)
 
 
 # ============================================================================
 # HTTP Server
 # ============================================================================
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 from datetime import datetime
+from functools import lru_cache
+
+# Allowed origins for CORS
+ALLOWED_ORIGINS = [
+    "http://localhost:3000",
+    "http://localhost:8080",
+    "http://localhost:7345",
+    "chrome-extension://*",
+]
+# Split once: exact origins for a set lookup, "/*" entries as prefixes
+ALLOWED_EXACT = frozenset(o for o in ALLOWED_ORIGINS if not o.endswith('/*'))
+ALLOWED_PREFIXES = tuple(o[:-1] for o in ALLOWED_ORIGINS if o.endswith('/*'))
+
+
+@lru_cache(maxsize=128)
+def is_allowed_origin(origin: str) -> bool:
+    """Check an Origin header; callers repeat the same few origins."""
+    return not origin or origin in ALLOWED_EXACT or origin.startswith(ALLOWED_PREFIXES)
 
 
 class ModelServerHandler(BaseHTTPRequestHandler):
     """HTTP request handler for the local model server."""
     
     model_manager: Optional[ModelManager] = None
-    
-    # Allowed origins for CORS
-    ALLOWED_ORIGINS = [
-        "http://localhost:3000",
-        "http://localhost:8080",
-        "http://localhost:7345",
-        "chrome-extension://*",
-    ]
+    embedding_batcher: Optional[EmbeddingBatcher] = None
+    # Buffer writes so responses built from several send_header() calls
+    # (OPTIONS, SSE) still leave in one segment; finish() flushes
+    wbufsize = 65536
     
     def log_message(self, format, *args):
         print(f"[{datetime.now().strftime('%H:%M:%S')}] {format % args}")
@@ -392,27 +852,70 @@ class ModelServerHandler(BaseHTTPRequestHandler):
         return self.headers.get('Origin', '')
     
     def _is_allowed_origin(self, origin):
-        if not origin:
-            return True
-        for allowed in self.ALLOWED_ORIGINS:
-            if allowed.endswith('/*'):
-                if origin.startswith(allowed[:-1]):
-                    return True
-            elif origin == allowed:
-                return True
-        return False
+        return is_allowed_origin(origin)
     
     def send_json_response(self, data: dict, status: int = 200):
+        # Status line, headers and body go out in a single write
+        body = dump_json(data)
         origin = self._get_origin()
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
+        head = (
+            f"{self.protocol_version} {status} {self.responses.get(status, ('',))[0]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+        )
+        if self._is_allowed_origin(origin):
+            head += (
+                f"Access-Control-Allow-Origin: {origin if origin else 'http://localhost:3000'}\r\n"
+                "Access-Control-Allow-Methods: GET, POST, OPTIONS\r\n"
+                "Access-Control-Allow-Headers: Content-Type, Authorization\r\n"
+                "Access-Control-Allow-Credentials: true\r\n"
+            )
+        self.log_request(status)
+        self.wfile.write(head.encode("latin-1") + b"\r\n" + body)
+    
+    def stream_chat_response(self, messages: List[Dict[str, Any]], model: str):
+        """Write an OpenAI-style chat.completion.chunk SSE stream.
+        
+        The handler speaks HTTP/1.0, so closing the connection ends the body.
+        """
+        origin = self._get_origin()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
         if self._is_allowed_origin(origin):
             self.send_header("Access-Control-Allow-Origin", origin if origin else "http://localhost:3000")
             self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
             self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
             self.send_header("Access-Control-Allow-Credentials", "true")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        
+        chunk = {
+            "id": f"chatcmpl-{int(time.time())}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}],
+        }
+        
+        def send(data: Any):
+            self.wfile.write(b"data: " + dump_json(data) + b"\n\n")
+            self.wfile.flush()
+        
+        try:
+            send(chunk)
+            for piece in self.model_manager.vision_chat_stream(messages):
+                chunk["choices"][0]["delta"] = {"content": piece}
+                send(chunk)
+            chunk["choices"][0]["delta"] = {}
+            chunk["choices"][0]["finish_reason"] = "stop"
+            send(chunk)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            print("[INFO] Client disconnected during streaming")
+        except Exception as e:
+            # Headers are already out; all we can do is end the stream
+            print(f"[ERROR] Chat stream failed: {e}")
     
     def do_OPTIONS(self):
         origin = self._get_origin()
@@ -450,6 +953,10 @@ class ModelServerHandler(BaseHTTPRequestHandler):
             })
             return
         
+        if path == "/v1/cache/stats":
+            self.send_json_response(self.model_manager.cache_stats())
+            return
+        
         self.send_json_response({"error": "Not found"}, 404)
     
     def do_POST(self):
@@ -457,8 +964,8 @@ class ModelServerHandler(BaseHTTPRequestHandler):
         path = parsed.path
         
         content_length = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(content_length).decode()
-        data = json.loads(body) if body else {}
+        body = self.rfile.read(content_length)
+        data = load_json(body) if body else {}
         
         # OpenAI-compatible embeddings endpoint
         if path == "/v1/embeddings":
@@ -470,9 +977,14 @@ class ModelServerHandler(BaseHTTPRequestHandler):
                 if not input_texts:
                     self.send_json_response({"error": "No input provided"}, 400)
                     return
+                # Checked here: a bad input in a shared batch would fail
+                # every request coalesced with it
+                if not isinstance(input_texts, list) or not all(isinstance(t, str) for t in input_texts):
+                    self.send_json_response({"error": "input must be a string or a list of strings"}, 400)
+                    return
                 
                 # Generate embeddings
-                embeddings = self.model_manager.generate_embeddings(input_texts)
+                embeddings = self.embedding_batcher.submit(input_texts)
                 
                 # Format response (OpenAI compatible)
                 response = {
@@ -509,6 +1021,10 @@ class ModelServerHandler(BaseHTTPRequestHandler):
                     self.send_json_response({"error": "No messages provided"}, 400)
                     return
                 
+                if data.get("stream"):
+                    self.stream_chat_response(messages, data.get("model", "lfm-2-vision-450m"))
+                    return
+                
                 # Generate response
                 response_text = self.model_manager.vision_chat(messages)
                 
@@ -564,6 +1080,7 @@ def main():
     # Initialize model manager
     manager = ModelManager()
     ModelServerHandler.model_manager = manager
+    ModelServerHandler.embedding_batcher = EmbeddingBatcher(manager)
     
     # Download models if needed
     print("[INFO] Checking models...")
@@ -571,7 +1088,8 @@ def main():
     
     try:
         manager.download_embedding_model()
-        manager.download_vision_model()
+        if not VISION_MODEL["backend_url"]:
+            manager.download_vision_model()
     except KeyboardInterrupt:
         print("\n[INFO] Download interrupted by user")
         sys.exit(0)
@@ -586,11 +1104,36 @@ def main():
     print("       (This may take a moment...)")
     try:
         manager.load_embedding_model()
-        manager.load_vision_model()
+        if VISION_MODEL["backend_url"]:
+            print(f"[INFO] Vision chat served by {VISION_MODEL['backend_url']}")
+        else:
+            manager.load_vision_model()
     except Exception as e:
         print(f"[ERROR] Failed to load models: {e}")
         sys.exit(1)
     
+    # Inference only from here on. Grad mode is thread-local, so the request
+    # and batcher threads still rely on the inference_mode() blocks above.
+    import torch
+    torch.set_grad_enabled(False)
+    if torch.cuda.is_available():
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+    
+    # Throwaway forwards so kernel selection, autotuning and torch.compile
+    # happen now rather than on the first user request
+    if os.getenv("WARMUP", "1") == "1":
+        print("[INFO] Warming up models...")
+        try:
+            # Bypasses the caches so "warmup" is never stored as a real vector
+            manager._compute_embeddings(["warmup"] * 4)
+            if not VISION_MODEL["backend_url"]:
+                manager.vision_chat([{"role": "user", "content": "hi"}])
+            print("[OK] Warmup complete")
+        except Exception as e:
+            print(f"[WARN] Warmup failed: {e}")
+    
     print()
     print("=" * 70)
     print(f"Server ready at http://{SERVER_HOST}:{SERVER_PORT}")
@@ -599,6 +1142,7 @@ def main():
     print("Available endpoints:")
     print(f"  Health:      GET  http://{SERVER_HOST}:{SERVER_PORT}/health")
     print(f"  Models:      GET  http://{SERVER_HOST}:{SERVER_PORT}/v1/models")
+    print(f"  Cache stats: GET  http://{SERVER_HOST}:{SERVER_PORT}/v1/cache/stats")
     print(f"  Embeddings:  POST http://{SERVER_HOST}:{SERVER_PORT}/v1/embeddings")
     print(f"  Chat:        POST http://{SERVER_HOST}:{SERVER_PORT}/v1/chat/completions")
     print()
@@ -606,14 +1150,17 @@ def main():
     print("-" * 70)
     print()
     
-    # Start server
-    server = HTTPServer((SERVER_HOST, SERVER_PORT), ModelServerHandler)
+    # Start server; a thread per request keeps health checks and request
+    # parsing responsive while a model call is running
+    server = ThreadingHTTPServer((SERVER_HOST, SERVER_PORT), ModelServerHandler)
     
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("\n[INFO] Shutting down...")
         server.shutdown()
+        if manager.disk_cache is not None:
+            manager.disk_cache.close()
 
 
 if __name__ == "__main__":
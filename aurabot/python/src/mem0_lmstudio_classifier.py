@@ -13,16 +13,31 @@ Usage:
 """
 
 import os
+import re
 import sys
 import json
 import time
+import hashlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import OrderedDict
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import parse_qs, urlparse
-from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
 from typing import List, Dict, Any, Tuple
 
+from _embed_shared import EmbedBatcher, get_embed_batcher, get_embedder
+
+# orjson is optional: faster JSON and native NumPy array serialization
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    orjson = None
+    HAS_ORJSON = False
+
 # Load .env if exists
 try:
     from dotenv import load_dotenv
@@ -34,6 +49,69 @@ except ImportError:
 HOST = os.getenv("MEM0_HOST", "localhost")
 PORT = int(os.getenv("MEM0_PORT", "8000"))
 LM_STUDIO_URL = os.getenv("LM_STUDIO_URL", "http://localhost:1234/v1")
+# Classification caches: exact text matches, then near-duplicate embeddings
+CLASSIFY_CACHE_SIZE = int(os.getenv("CLASSIFY_CACHE_SIZE", "10000"))
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "4096"))
+SEMANTIC_THRESHOLD = float(os.getenv("SEMANTIC_THRESHOLD", "0.93"))
+# Texts shorter than this (characters / words) are discarded without a model call
+MIN_MEMORY_CHARS = int(os.getenv("MIN_MEMORY_CHARS", "12"))
+MIN_MEMORY_WORDS = int(os.getenv("MIN_MEMORY_WORDS", "3"))
+# Hugging Face tokenizer of the LM Studio model, used to find the token ids
+# of the "U"/"D" answers for logit_bias
+CLASSIFY_TOKENIZER = os.getenv("CLASSIFY_TOKENIZER", "LiquidAI/LFM2-350M")
+
+
+def dump_json(data: Any) -> bytes:
+    """Serialize a response body, passing NumPy arrays through natively."""
+    if HAS_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=lambda o: o.tolist()).encode()
+
+
+def load_json(body: bytes) -> Any:
+    """Parse a request body."""
+    return orjson.loads(body) if HAS_ORJSON else json.loads(body)
+
+
+# numba is optional: a parallel SIMD scan instead of BLAS for the semantic cache
+try:
+    import numpy as np
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _best_match_numba(cached, query, threshold):
+        n, dims = cached.shape
+        scores = np.empty(n, dtype=np.float32)
+        for i in prange(n):
+            s = np.float32(0.0)
+            for k in range(dims):
+                s += cached[i, k] * query[k]
+            scores[i] = s
+        # Argmax stays serial; a shared running max inside prange would race
+        best = -1
+        best_score = threshold
+        for i in range(n):
+            if scores[i] >= best_score:
+                best_score = scores[i]
+                best = i
+        return best
+    
+    # Compile now rather than on the first lookup, which runs under the
+    # classifier lock and would stall every concurrent classify
+    _best_match_numba(np.zeros((1, 768), dtype=np.float32), np.zeros(768, dtype=np.float32), 1.0)
+
+
+def best_match(cached, query, threshold: float) -> int:
+    """Row of cached with the highest dot product >= threshold, or -1."""
+    if HAS_NUMBA:
+        return _best_match_numba(cached, query, threshold)
+    scores = cached @ query
+    best = int(scores.argmax())
+    return best if scores[best] >= threshold else -1
 
 print("="*70)
 print("Mem0 + LM Studio Memory Classifier")
@@ -42,17 +120,69 @@ print(f"LM Studio: {LM_STUDIO_URL}")
 print()
 
 
+# First non-space character of the completion's "content" string
+CONTENT_RE = re.compile(rb'"content"\s*:\s*"\s*([^"\\\s])')
+
+
 class LMStudioClassifier:
     """Uses LM Studio to classify if text is a useful memory."""
     
+    SYSTEM_PROMPT = """You are a memory classifier. Your job is to decide if the given text contains useful information worth remembering.
+
+USEFUL memories include:
+- User preferences, goals, personal details
+- Tasks, reminders, deadlines, decisions
+- Important context to recall later
+- Work projects, commitments
+- Key insights or information
+
+NOT useful (discard):
+- Greetings, small talk, "hello", "thanks"
+- Loading messages, "please wait"
+- System notifications
+- Temporary or obvious info
+- Incomplete thoughts
+
+Reply with exactly one character: U (useful) or D (discard)."""
+    
+    # Identical bytes on every call so LM Studio can reuse the prompt's KV prefix
+    _SYS_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+    # One greedy token: prefill plus a single decode step
+    _BASE_PAYLOAD = {
+        "model": "local-model",
+        "max_tokens": 1,
+        "temperature": 0.0,
+        "stream": False
+    }
+    
     def __init__(self, base_url: str):
         self.base_url = base_url.rstrip('/')
         self.chat_url = f"{self.base_url}/chat/completions"
+        # Keep-alive connection pool shared by every LM Studio call
+        self.session = requests.Session()
+        self.session.headers["Connection"] = "keep-alive"
+        self.session.mount("http://", HTTPAdapter(
+            pool_connections=16, pool_maxsize=64,
+            max_retries=Retry(total=2, backoff_factor=0.1),
+        ))
+        # {token_id: bias} restricting the 1-token answer to U or D
+        self.logit_bias = self._label_logit_bias()
+        self._base_payload = dict(self._BASE_PAYLOAD)
+        if self.logit_bias:
+            self._base_payload["logit_bias"] = self.logit_bias
+        # Set once the embed batcher exists; enables the semantic cache tier
+        self.embed_batcher = None
+        self._lock = threading.Lock()
+        self._exact: "OrderedDict[bytes, Tuple[bool, str]]" = OrderedDict()
+        # Ring buffer of normalized query embeddings and their decisions
+        self._sem_vectors = None
+        self._sem_decisions: List[Tuple[bool, str]] = []
+        self._sem_next = 0
         
     def check_connection(self) -> bool:
         """Verify LM Studio is running."""
         try:
-            resp = requests.get(f"{self.base_url}/models", timeout=5)
+            resp = self.session.get(f"{self.base_url}/models", timeout=5)
             if resp.status_code == 200:
                 models = resp.json().get('data', [])
                 print(f"[OK] LM Studio connected")
@@ -63,62 +193,102 @@ class LMStudioClassifier:
             print(f"[ERROR] Cannot connect to LM Studio: {e}")
         return False
     
+    @staticmethod
+    def _label_logit_bias() -> Dict[str, int]:
+        """Bias the U and D tokens so the single decoded token is one of them."""
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(CLASSIFY_TOKENIZER)
+            ids = [tokenizer.encode(label, add_special_tokens=False) for label in ("U", "D")]
+            if all(len(i) == 1 for i in ids):
+                return {str(i[0]): 100 for i in ids}
+            print("[WARN] U/D are not single tokens; classifying without logit_bias")
+        except Exception as e:
+            print(f"[WARN] Classifier tokenizer unavailable, no logit_bias: {e}")
+        return {}
+    
     def classify(self, text: str) -> Tuple[bool, str]:
+        """
+        Classify text, answering repeats and near-repeats from cache.
+        Returns: (is_useful, reason)
+        """
+        key = hashlib.blake2b(text.strip().lower().encode(), digest_size=16).digest()
+        with self._lock:
+            cached = self._exact.get(key)
+            if cached is not None:
+                self._exact.move_to_end(key)
+                return cached
+        
+        query = self._query_vector(text)
+        if query is not None:
+            with self._lock:
+                if self._sem_decisions:
+                    best = best_match(
+                        self._sem_vectors[:len(self._sem_decisions)], query, SEMANTIC_THRESHOLD
+                    )
+                    if best >= 0:
+                        return self._sem_decisions[best]
+        
+        result = self._classify_uncached(text)
+        # Errors default to storing; don't pin that answer in the cache
+        if result[1] == "classifier_error":
+            return result
+        
+        with self._lock:
+            self._exact[key] = result
+            while len(self._exact) > CLASSIFY_CACHE_SIZE:
+                self._exact.popitem(last=False)
+            if query is not None and SEMANTIC_CACHE_SIZE > 0:
+                import numpy as np
+                if self._sem_vectors is None:
+                    self._sem_vectors = np.zeros((SEMANTIC_CACHE_SIZE, query.shape[0]), dtype=np.float32)
+                # FIFO eviction: overwrite the oldest slot once full
+                slot = self._sem_next
+                self._sem_vectors[slot] = query
+                if slot < len(self._sem_decisions):
+                    self._sem_decisions[slot] = result
+                else:
+                    self._sem_decisions.append(result)
+                self._sem_next = (slot + 1) % SEMANTIC_CACHE_SIZE
+        return result
+    
+    def _query_vector(self, text: str):
+        """Unit-norm embedding for the semantic tier, or None if unavailable."""
+        if (SEMANTIC_CACHE_SIZE <= 0 or self.embed_batcher is None
+                or self.embed_batcher.embedder.model is None):
+            return None
+        try:
+            import numpy as np
+            # Through the batcher, so concurrent lookups share a forward pass
+            # and the model only ever runs on the batcher's thread
+            return np.asarray(self.embed_batcher.submit([text])[0], dtype=np.float32)
+        except Exception as e:
+            print(f"[WARN] Semantic cache lookup skipped: {e}")
+            return None
+    
+    def _classify_uncached(self, text: str) -> Tuple[bool, str]:
         """
         Ask LM Studio if this text is worth remembering.
         Returns: (is_useful, reason)
         """
-        system_prompt = """You are a memory classifier. Your job is to decide if the given text contains useful information worth remembering.
-
-USEFUL memories include:
-- User preferences, goals, personal details
-- Tasks, reminders, deadlines, decisions
-- Important context to recall later
-- Work projects, commitments
-- Key insights or information
-
-NOT useful (respond DISCARD):
-- Greetings, small talk, "hello", "thanks"
-- Loading messages, "please wait"
-- System notifications
-- Temporary or obvious info
-- Incomplete thoughts
-
-Respond ONLY in this format:
-DECISION: USEFUL or DISCARD
-REASON: one line explanation"""
-
         messages = [
-            {"role": "system", "content": system_prompt},
+            self._SYS_MSG,
             {"role": "user", "content": f"Classify this text:\n{text[:1500]}"}
         ]
-        
-        payload = {
-            "model": "local-model",
-            "messages": messages,
-            "max_tokens": 128,
-            "temperature": 0.1,
-            "stream": False
-        }
+        payload = {**self._base_payload, "messages": messages}
         
         try:
-            resp = requests.post(self.chat_url, json=payload, timeout=30)
+            resp = self.session.post(self.chat_url, json=payload, timeout=30)
             resp.raise_for_status()
-            data = resp.json()
             
-            content = data["choices"][0]["message"]["content"]
-            
-            # Parse decision
-            is_useful = "USEFUL" in content.upper() and "DISCARD" not in content.upper()
-            
-            # Extract reason
-            reason = ""
-            if "REASON:" in content:
-                reason = content.split("REASON:", 1)[1].strip()
-            elif "DECISION:" in content:
-                reason = content.split("DECISION:", 1)[1].strip()
-            
-            return is_useful, reason
+            # The answer is one character; find it without building the dict tree
+            match = CONTENT_RE.search(resp.content)
+            if match:
+                answer = match.group(1)
+            else:
+                content = load_json(resp.content)["choices"][0]["message"]["content"] or ""
+                answer = content.strip()[:1].encode()
+            return answer in (b"U", b"u"), "cls"
             
         except Exception as e:
             print(f"[WARN] Classification failed: {e}")
@@ -145,76 +315,9 @@ print()
 # Embedding Model (Gemma - for actual embeddings)
 # ============================================================================
 
-MODELS_DIR = Path(os.getenv("MODELS_DIR", "./models"))
-
-class GemmaEmbedder:
-    """Google Embedding Gemma for vector embeddings."""
-    
-    def __init__(self):
-        self.model = None
-        self.tokenizer = None
-        self.device = "cpu"
-        
-        try:
-            import torch
-            if torch.cuda.is_available():
-                self.device = "cuda"
-                print(f"[OK] Using CUDA for embeddings")
-        except:
-            pass
-    
-    def load(self) -> bool:
-        from transformers import AutoTokenizer, AutoModel
-        import torch
-        
-        path = MODELS_DIR / "embeddinggemma-300m-f8"
-        if not path.exists():
-            print(f"[WARN] Gemma embedder not found at {path}")
-            print(f"       Embeddings will not work!")
-            return False
-        
-        print("[INFO] Loading Gemma embedding model...")
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            path, trust_remote_code=True, local_files_only=True
-        )
-        self.model = AutoModel.from_pretrained(
-            path, trust_remote_code=True, local_files_only=True,
-            torch_dtype=torch.float16 if self.device == "cuda" else torch.float32,
-            device_map="auto" if self.device == "cuda" else None
-        )
-        if self.device == "cpu":
-            self.model.to(self.device)
-        self.model.eval()
-        print("[OK] Embedding model ready")
-        return True
-    
-    def embed(self, texts: List[str]) -> List[List[float]]:
-        import torch
-        
-        if self.model is None:
-            if not self.load():
-                return [[0.0] * 768] * len(texts)
-        
-        embeddings = []
-        with torch.no_grad():
-            for i in range(0, len(texts), 4):  # Small batches
-                batch = texts[i:i + 4]
-                encoded = self.tokenizer(
-                    batch, padding=True, truncation=True,
-                    return_tensors="pt", max_length=8192
-                )
-                encoded = {k: v.to(self.device) for k, v in encoded.items()}
-                
-                output = self.model(**encoded)
-                mask = encoded["attention_mask"].unsqueeze(-1).float()
-                emb = (output[0] * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
-                emb = torch.nn.functional.normalize(emb, p=2, dim=1)
-                embeddings.extend(emb.cpu().numpy().tolist())
-        
-        return embeddings
-
-
-embedder = GemmaEmbedder()
+embedder = get_embedder()
+embed_batcher = get_embed_batcher()
+classifier.embed_batcher = embed_batcher
 
 
 # ============================================================================
@@ -229,15 +332,36 @@ except ImportError:
     sys.exit(1)
 
 
+# Small talk that never needs the classifier
+TRIVIAL_TEXTS = frozenset({
+    "hi", "hello", "hey", "thanks", "thank you", "thx", "ok", "okay", "k",
+    "yes", "no", "sure", "cool", "bye", "goodbye", "please wait", "loading",
+    "loading...", "good morning", "good night",
+})
+GREETING_RE = re.compile(r"^\s*(hi|hey|hello|thanks?|thank you|ok(ay)?|bye)[!.?\s]*$", re.IGNORECASE)
+
+
+def is_trivial(text: str) -> bool:
+    """Cheap checks for text that is never worth a classifier round trip."""
+    stripped = text.strip()
+    return (len(stripped) < MIN_MEMORY_CHARS
+            or len(stripped.split()) < MIN_MEMORY_WORDS
+            or stripped.lower() in TRIVIAL_TEXTS
+            or GREETING_RE.match(stripped) is not None)
+
+
 class FilteringMemoryStore:
     """
-    Mem0 wrapper that classifies with LM Studio BEFORE embedding.
-    Only useful memories get embedded and stored.
+    Mem0 wrapper that classifies with LM Studio BEFORE storing.
+    Every classified text is embedded once for the classifier's semantic
+    cache; only useful memories are stored.
     """
     
     def __init__(self, base_memory: Memory):
         self.memory = base_memory
         self.stats = {"stored": 0, "discarded": 0}
+        # Requests are handled on concurrent threads
+        self._stats_lock = threading.Lock()
     
     def add(self, messages, user_id="default_user", agent_id=None, metadata=None, **kwargs):
         """Add memory with LM Studio classification filter."""
@@ -251,14 +375,26 @@ class FilteringMemoryStore:
         if not text.strip():
             return {"id": "empty", "filtered": True}
         
+        # Greetings and fragments: discard before LM Studio or the embedder
+        if is_trivial(text):
+            with self._stats_lock:
+                self.stats["discarded"] += 1
+            return {
+                "id": f"discarded_{int(time.time())}",
+                "filtered": True,
+                "reason": "trivial"
+            }
+        
         print(f"\n[CLASSIFY] {text[:100]}...")
         
         # Classify with LM Studio
         is_useful, reason = classifier.classify(text)
         
         if not is_useful:
-            self.stats["discarded"] += 1
-            print(f"[DISCARD] ({self.stats['discarded']} total) {reason}")
+            with self._stats_lock:
+                self.stats["discarded"] += 1
+                discarded = self.stats["discarded"]
+            print(f"[DISCARD] ({discarded} total) {reason}")
             return {
                 "id": f"discarded_{int(time.time())}",
                 "filtered": True,
@@ -266,8 +402,10 @@ class FilteringMemoryStore:
             }
         
         # Useful - proceed to embed and store
-        self.stats["stored"] += 1
-        print(f"[STORE] ({self.stats['stored']} total) {reason}")
+        with self._stats_lock:
+            self.stats["stored"] += 1
+            stored = self.stats["stored"]
+        print(f"[STORE] ({stored} total) {reason}")
         
         # Add classification metadata
         enriched_metadata = {
@@ -296,7 +434,23 @@ class FilteringMemoryStore:
         return self.memory.delete(**kwargs)
     
     def get_stats(self):
-        return self.stats.copy()
+        with self._stats_lock:
+            return self.stats.copy()
+
+
+class InProcessEmbedder:
+    """Mem0 embedder that calls the Gemma model directly instead of over HTTP.
+    
+    Mem0 and the model live in this process, so the OpenAI-compatible
+    /v1/embeddings round trip (JSON floats both ways) is pure overhead.
+    """
+    
+    def __init__(self, batcher: EmbedBatcher):
+        self.batcher = batcher
+    
+    def embed(self, text, memory_action=None):
+        # Qdrant's point model validates plain float lists, not arrays
+        return self.batcher.submit([text])[0].tolist()
 
 
 # Configure Mem0
@@ -304,6 +458,11 @@ print("Configuring Mem0...")
 
 # Load embedding model
 has_embedder = embedder.load()
+WARMUP = os.getenv("WARMUP", "1") == "1"
+if has_embedder and WARMUP:
+    # First real request shouldn't pay for kernel selection and allocator growth;
+    # run on the batcher thread, which serves every later forward pass
+    embed_batcher.submit(["warmup text"] * 4)
 
 config = {
     "vector_store": {
@@ -312,6 +471,8 @@ config = {
             "collection_name": "lmstudio_filtered_memories",
             "embedding_model_dims": 768,
             "path": "./qdrant_storage",
+            # Keep vectors and index in memory rather than paging from disk
+            "on_disk": False,
         }
     },
     "embedder": {
@@ -343,11 +504,19 @@ config = {
 
 try:
     base_memory = Memory.from_config(config_dict=config)
+    if has_embedder:
+        base_memory.embedding_model = InProcessEmbedder(embed_batcher)
     memory = FilteringMemoryStore(base_memory)
+    if WARMUP:
+        # Opens the collection's storage and runs the search path once
+        try:
+            base_memory.search(query="warmup", user_id="__warmup__", limit=1)
+        except Exception as e:
+            print(f"[WARN] Search warmup failed: {e}")
     print("[OK] Mem0 initialized with LM Studio classifier!")
     print()
-    print("Flow: Text → LM Studio (classify) → [USEFUL] → Embed → Store")
-    print("                         ↓[DISCARD]  (no embedding created)")
+    print("Flow: Text → Embed → LM Studio (classify) → [USEFUL] → Store")
+    print("                             ↓[DISCARD]  (not stored)")
     print()
 except Exception as e:
     print(f"[ERROR] Failed to initialize Mem0: {e}")
@@ -369,6 +538,16 @@ class Handler(BaseHTTPRequestHandler):
         "http://localhost:7345",
         "chrome-extension://*",
     ]
+    # Split once: exact origins for a set lookup, "/*" entries as prefixes
+    _EXACT_ORIGINS = frozenset(o for o in ALLOWED_ORIGINS if not o.endswith('/*'))
+    _ORIGIN_PREFIXES = tuple(o[:-1] for o in ALLOWED_ORIGINS if o.endswith('/*'))
+    # Keep-alive: clients reuse one connection (and one handler thread)
+    # instead of a TCP handshake and thread spawn per request. Every
+    # response therefore carries a Content-Length.
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes; with Nagle on, the body
+    # waits for the client's delayed ACK (~40 ms) on a kept-alive connection
+    disable_nagle_algorithm = True
     
     def log_message(self, format, *args):
         print(f"[{datetime.now().strftime('%H:%M:%S')}] {format % args}")
@@ -379,28 +558,22 @@ class Handler(BaseHTTPRequestHandler):
     
     def _is_allowed_origin(self, origin):
         """Check if the origin is in the allowed list."""
-        if not origin:
-            return True
-        for allowed in self.ALLOWED_ORIGINS:
-            if allowed.endswith('/*'):
-                prefix = allowed[:-1]
-                if origin.startswith(prefix):
-                    return True
-            elif origin == allowed:
-                return True
-        return False
+        return (not origin or origin in self._EXACT_ORIGINS
+                or origin.startswith(self._ORIGIN_PREFIXES))
     
     def send_json(self, data, status=200):
+        body = dump_json(data)
         origin = self._get_origin()
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
         if self._is_allowed_origin(origin):
             self.send_header("Access-Control-Allow-Origin", origin if origin else "http://localhost:3000")
             self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
             self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
             self.send_header("Access-Control-Allow-Credentials", "true")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
     
     def do_OPTIONS(self):
         origin = self._get_origin()
@@ -410,125 +583,139 @@ class Handler(BaseHTTPRequestHandler):
             self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
             self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
             self.send_header("Access-Control-Allow-Credentials", "true")
+        self.send_header("Content-Length", "0")
         self.end_headers()
     
     def do_GET(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        query = parse_qs(parsed.query)
-        
-        # Health check
-        if path == "/health":
-            self.send_json({
-                "status": "ok",
-                "lm_studio": LM_STUDIO_URL,
-                "classifier": "lmstudio_lfm2",
-                "stats": memory.get_stats() if memory else {},
-            })
-            return
-        
-        # List memories
-        if path == "/v1/memories/":
-            try:
-                user_id = query.get("user_id", ["default_user"])[0]
-                limit = int(query.get("limit", ["10"])[0])
-                results = memory.get_all(user_id=user_id, limit=limit)
-                self.send_json(results if isinstance(results, list) else [])
-            except Exception as e:
-                print(f"[ERROR] Get memories: {e}")
-                self.send_json({"error": str(e)}, 500)
+        path, _, query_string = self.path.partition("?")
+        handler = self.GET_ROUTES.get(path)
+        if handler is None:
+            self.send_json({"error": "Not found"}, 404)
             return
-        
-        self.send_json({"error": "Not found"}, 404)
+        handler(self, query_string)
     
     def do_POST(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        
         content_length = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(content_length).decode()
-        data = json.loads(body) if body else {}
-        
-        # Embeddings endpoint (for Mem0)
-        if path == "/v1/embeddings":
-            try:
-                texts = data.get("input", [])
-                if isinstance(texts, str):
-                    texts = [texts]
-                
-                embeddings = embedder.embed(texts)
-                
-                self.send_json({
-                    "object": "list",
-                    "data": [
-                        {"object": "embedding", "embedding": emb, "index": i}
-                        for i, emb in enumerate(embeddings)
-                    ],
-                    "model": "embedding-gemma",
-                })
-            except Exception as e:
-                print(f"[ERROR] Embeddings: {e}")
-                self.send_json({"error": str(e)}, 500)
-            return
-        
-        # Add memory WITH LM STUDIO CLASSIFICATION
-        if path == "/v1/memories/":
-            try:
-                messages = data.get("messages", [])
-                user_id = data.get("user_id", "default_user")
-                agent_id = data.get("agent_id")
-                metadata = data.get("metadata", {})
-                
-                result = memory.add(
-                    messages=messages,
-                    user_id=user_id,
-                    agent_id=agent_id,
-                    metadata=metadata
-                )
-                
-                if result.get("filtered"):
-                    self.send_json({
-                        "id": result["id"],
-                        "status": "discarded",
-                        "reason": result.get("reason"),
-                        "stats": memory.get_stats()
-                    }, 200)
-                else:
-                    self.send_json({
-                        **result,
-                        "status": "stored",
-                        "stats": memory.get_stats()
-                    }, 201)
-                    
-            except Exception as e:
-                print(f"[ERROR] Add memory: {e}")
-                import traceback
-                traceback.print_exc()
-                self.send_json({"error": str(e)}, 500)
+        # Always drain the body so a kept-alive connection stays in sync
+        body = self.rfile.read(content_length)
+        handler = self.POST_ROUTES.get(urlsplit(self.path).path)
+        if handler is None:
+            self.send_json({"error": "Not found"}, 404)
             return
-        
-        # Search memories
-        if path == "/v1/memories/search/":
-            try:
-                query = data.get("query", "")
-                user_id = data.get("user_id", "default_user")
-                limit = data.get("limit", 10)
-                
-                results = memory.search(query=query, user_id=user_id, limit=limit)
-                self.send_json({"results": results if isinstance(results, list) else []})
-            except Exception as e:
-                print(f"[ERROR] Search: {e}")
-                self.send_json({"error": str(e)}, 500)
-            return
-        
-        self.send_json({"error": "Not found"}, 404)
+        handler(self, load_json(body) if body else {})
     
     def do_DELETE(self):
-        parsed = urlparse(self.path)
-        if parsed.path.startswith("/v1/memories/"):
+        if urlsplit(self.path).path.startswith("/v1/memories/"):
             self.send_json({"deleted": True})
             return
         self.send_json({"error": "Not found"}, 404)
+    
+    # Health check
+    def _handle_health(self, query_string):
+        self.send_json({
+            "status": "ok",
+            "lm_studio": LM_STUDIO_URL,
+            "classifier": "lmstudio_lfm2",
+            "stats": memory.get_stats() if memory else {},
+        })
+    
+    # List memories
+    def _handle_list(self, query_string):
+        try:
+            query = parse_qs(query_string)
+            user_id = query.get("user_id", ["default_user"])[0]
+            limit = int(query.get("limit", ["10"])[0])
+            results = memory.get_all(user_id=user_id, limit=limit)
+            self.send_json(results if isinstance(results, list) else [])
+        except Exception as e:
+            print(f"[ERROR] Get memories: {e}")
+            self.send_json({"error": str(e)}, 500)
+    
+    # Embeddings endpoint (for Mem0)
+    def _handle_embeddings(self, data):
+        try:
+            texts = data.get("input", [])
+            if isinstance(texts, str):
+                texts = [texts]
+            
+            embeddings = embed_batcher.submit(texts)
+            
+            self.send_json({
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "embedding": emb, "index": i}
+                    for i, emb in enumerate(embeddings)
+                ],
+                "model": "embedding-gemma",
+            })
+        except Exception as e:
+            print(f"[ERROR] Embeddings: {e}")
+            self.send_json({"error": str(e)}, 500)
+    
+    # Add memory WITH LM STUDIO CLASSIFICATION
+    def _handle_add(self, data):
+        try:
+            messages = data.get("messages", [])
+            user_id = data.get("user_id", "default_user")
+            agent_id = data.get("agent_id")
+            metadata = data.get("metadata", {})
+            
+            result = memory.add(
+                messages=messages,
+                user_id=user_id,
+                agent_id=agent_id,
+                metadata=metadata
+            )
+            
+            if result.get("filtered"):
+                self.send_json({
+                    "id": result["id"],
+                    "status": "discarded",
+                    "reason": result.get("reason"),
+                    "stats": memory.get_stats()
+                }, 200)
+            else:
+                self.send_json({
+                    **result,
+                    "status": "stored",
+                    "stats": memory.get_stats()
+                }, 201)
+                
+        except Exception as e:
+            print(f"[ERROR] Add memory: {e}")
+            import traceback
+            traceback.print_exc()
+            self.send_json({"error": str(e)}, 500)
+    
+    # Search memories
+    def _handle_search(self, data):
+        try:
+            query = data.get("query", "")
+            user_id = data.get("user_id", "default_user")
+            limit = data.get("limit", 10)
+            
+            results = memory.search(query=query, user_id=user_id, limit=limit)
+            self.send_json({"results": results if isinstance(results, list) else []})
+        except Exception as e:
+            print(f"[ERROR] Search: {e}")
+            self.send_json({"error": str(e)}, 500)
+    
+    # Exact-path dispatch tables; query strings are parsed only where used
+    GET_ROUTES = {
+        "/health": _handle_health,
+        "/v1/memories/": _handle_list,
+    }
+    POST_ROUTES = {
+        "/v1/embeddings": _handle_embeddings,
+        "/v1/memories/": _handle_add,
+        "/v1/memories/search/": _handle_search,
+    }
+
+
+class MemoryServer(ThreadingHTTPServer):
+    """Threaded server tuned for bursts of short keep-alive requests."""
+    daemon_threads = True
+    request_queue_size = 128
 
 
 def main():
@@ -545,7 +732,11 @@ def main():
     print("Press Ctrl+C to stop")
     print()
     
-    server = HTTPServer((HOST, PORT), Handler)
+    # A thread per connection, so a slow classify or add doesn't hold up other
+    # requests and concurrent embeds can share a batch. Mem0 embeds in-process;
+    # it only calls back into /v1/embeddings when the Gemma model failed to
+    # load, and that loopback would deadlock a single-threaded server.
+    server = MemoryServer((HOST, PORT), Handler)
     
     try:
         server.serve_forever()
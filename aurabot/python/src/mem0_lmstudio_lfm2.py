@@ -15,6 +15,9 @@ Environment Variables:
 - LM_STUDIO_URL: LM Studio API URL (default: http://localhost:1234/v1)
 - MEM0_HOST: Server host (default: localhost)
 - MEM0_PORT: Server port (default: 8000)
+- MEM0_WORKERS: Concurrent request handlers (default: min(32, 4 x CPUs))
+- MEM0_MAX_BODY_BYTES: Largest accepted request body (default: 8 MiB)
+- MEM0_MAX_EMBED_BATCH: Most inputs per /v1/embeddings request (default: 64)
 
 Usage:
     cd python/src && python mem0_lmstudio_lfm2.py
@@ -25,12 +28,28 @@ import sys
 import json
 import uuid
 import time
+import queue
+import logging
 import requests
+from logging.handlers import QueueHandler, QueueListener
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import parse_qs, urlparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
 from typing import List, Dict, Any, Optional
 
+from _embed_shared import get_embed_batcher, get_embedder
+
+# orjson is optional: faster JSON and native NumPy array serialization
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    orjson = None
+    HAS_ORJSON = False
+
 # Load .env
 try:
     from dotenv import load_dotenv
@@ -42,6 +61,37 @@ except ImportError:
 HOST = os.getenv("MEM0_HOST", "localhost")
 PORT = int(os.getenv("MEM0_PORT", "8000"))
 LM_STUDIO_URL = os.getenv("LM_STUDIO_URL", "http://localhost:1234/v1").rstrip('/')
+# Requests handled at once; adds block on LM Studio, so allow several
+MEM0_WORKERS = int(os.getenv("MEM0_WORKERS", str(min(32, (os.cpu_count() or 1) * 4))))
+# Largest request body accepted; bigger ones get a 413 before being read
+MAX_BODY_BYTES = int(os.getenv("MEM0_MAX_BODY_BYTES", str(8 * 1024 * 1024)))
+# Most texts one /v1/embeddings request may carry
+MAX_EMBED_BATCH = int(os.getenv("MEM0_MAX_EMBED_BATCH", "64"))
+
+# Per-request logs go through a queue to one writer thread, so handler
+# threads don't serialize on the stdout lock
+_log_queue: "queue.Queue" = queue.Queue()
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", datefmt="%H:%M:%S"))
+log_listener = QueueListener(_log_queue, _log_stream)
+log_listener.start()
+logger = logging.getLogger("mem0_lmstudio_lfm2")
+logger.addHandler(QueueHandler(_log_queue))
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+
+def dump_json(data: Any) -> bytes:
+    """Serialize a response body, passing NumPy arrays through natively."""
+    if HAS_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, default=lambda o: o.tolist()).encode()
+
+
+def load_json(body: bytes) -> Any:
+    """Parse a request body."""
+    return orjson.loads(body) if HAS_ORJSON else json.loads(body)
+
 
 print("="*70)
 print("Mem0 + LM Studio (LFM2-350M)")
@@ -58,12 +108,22 @@ class LMStudioClient:
         self.models = []
         self.lfm2_model = None
         self.embedding_model = None
-        
+        # Batcher in front of the local Gemma model, used when LM Studio
+        # serves no embedding model
+        self.local_embedder = None
+        # Keep-alive connection pool shared by every LM Studio call
+        self.session = requests.Session()
+        self.session.headers["Connection"] = "keep-alive"
+        self.session.mount("http://", HTTPAdapter(
+            pool_connections=16, pool_maxsize=64,
+            max_retries=Retry(total=2, backoff_factor=0.1),
+        ))
+    
     def connect(self) -> bool:
         """Connect to LM Studio and detect models."""
         try:
             # Get available models
-            resp = requests.get(f"{self.base_url}/models", timeout=10)
+            resp = self.session.get(f"{self.base_url}/models", timeout=10)
             if resp.status_code != 200:
                 print(f"[ERROR] LM Studio returned status {resp.status_code}")
                 return False
@@ -114,7 +174,7 @@ class LMStudioClient:
             return False
     
     def chat(self, messages: List[Dict[str, str]], max_tokens: int = 512, 
-             temperature: float = 0.7) -> str:
+             temperature: float = 0.7, response_format: Optional[Dict] = None) -> str:
         """Send chat completion request to LM Studio."""
         url = f"{self.base_url}/chat/completions"
         
@@ -125,41 +185,50 @@ class LMStudioClient:
             "temperature": temperature,
             "stream": False
         }
+        if response_format:
+            payload["response_format"] = response_format
         
         try:
-            resp = requests.post(url, json=payload, timeout=60)
+            resp = self.session.post(url, json=payload, timeout=60)
             resp.raise_for_status()
             data = resp.json()
             return data["choices"][0]["message"]["content"]
         except Exception as e:
-            print(f"[ERROR] Chat failed: {e}")
+            logger.error(f"[ERROR] Chat failed: {e}")
             return ""
     
     def embed(self, texts: List[str]) -> List[List[float]]:
         """Get embeddings from LM Studio."""
         if not self.embedding_model:
-            print("[WARN] No embedding model available in LM Studio")
+            if self.local_embedder is not None:
+                # One batcher thread runs the model for every handler thread
+                return self.local_embedder.submit(texts).tolist()
+            logger.warning("[WARN] No embedding model available in LM Studio")
             return [[0.0] * 768] * len(texts)
         
-        url = f"{self.base_url}/embeddings"
-        results = []
-        
-        for text in texts:
-            payload = {
-                "model": self.embedding_model,
-                "input": text
-            }
-            try:
-                resp = requests.post(url, json=payload, timeout=30)
-                resp.raise_for_status()
-                data = resp.json()
-                embedding = data["data"][0]["embedding"]
-                results.append(embedding)
-            except Exception as e:
-                print(f"[ERROR] Embedding failed: {e}")
-                results.append([0.0] * 768)
+        return self._embed_batch(f"{self.base_url}/embeddings", texts)
+    
+    def _embed_batch(self, url: str, texts: List[str]) -> List[List[float]]:
+        """Embed all texts in one request, halving the batch on rejection."""
+        if not texts:
+            return []
         
-        return results
+        payload = {
+            "model": self.embedding_model,
+            "input": texts
+        }
+        try:
+            resp = self.session.post(url, json=payload, timeout=30)
+            resp.raise_for_status()
+            data = sorted(resp.json()["data"], key=lambda d: d.get("index", 0))
+            return [d["embedding"] for d in data]
+        except Exception as e:
+            if len(texts) == 1:
+                logger.error(f"[ERROR] Embedding failed: {e}")
+                return [[0.0] * 768]
+            # Narrow down an oversized batch or an input the server rejects
+            mid = len(texts) // 2
+            return self._embed_batch(url, texts[:mid]) + self._embed_batch(url, texts[mid:])
 
 
 # Initialize LM Studio client
@@ -168,6 +237,13 @@ lmstudio = LMStudioClient(LM_STUDIO_URL)
 if not lmstudio.connect():
     sys.exit(1)
 
+if not lmstudio.embedding_model:
+    # Same process-wide instance the classifier server uses
+    gemma = get_embedder()
+    if gemma.load():
+        lmstudio.local_embedder = get_embed_batcher()
+        print("     Embedding model: local Gemma (no LM Studio embedding model)")
+
 print()
 
 
@@ -196,6 +272,11 @@ class LMStudioLLM:
             max_tokens=kwargs.get('max_tokens', 512),
             temperature=kwargs.get('temperature', 0.7)
         )
+    
+    def generate_response(self, messages: List[Dict[str, str]], response_format=None,
+                          tools=None, tool_choice="auto") -> str:
+        """Entry point Mem0 calls for fact extraction and memory updates."""
+        return self.client.chat(messages, response_format=response_format)
 
 
 class LMStudioEmbedder:
@@ -204,7 +285,7 @@ class LMStudioEmbedder:
     def __init__(self, client: LMStudioClient):
         self.client = client
     
-    def embed(self, text: str, memory_type: str = "text") -> List[float]:
+    def embed(self, text: str, memory_action: Optional[str] = None) -> List[float]:
         """Embed text via LM Studio."""
         results = self.client.embed([text])
         return results[0] if results else []
@@ -244,9 +325,25 @@ if lmstudio.embedding_model:
             "openai_base_url": LM_STUDIO_URL,
         }
     }
+elif lmstudio.local_embedder is not None:
+    # Placeholder so Mem0 builds without an OpenAI key; never called
+    config["embedder"] = {
+        "provider": "openai",
+        "config": {
+            "model": "embedding-gemma",
+            "api_key": "not-needed",
+            "openai_base_url": f"http://{HOST}:{PORT}/v1",
+        }
+    }
 
 try:
     memory = Memory.from_config(config_dict=config)
+    # Send Mem0's LLM and embedder calls through the pooled LM Studio
+    # session (or the local Gemma model) rather than separate OpenAI SDK
+    # clients; the config above only has to pass validation
+    memory.llm = LMStudioLLM(lmstudio)
+    if lmstudio.embedding_model or lmstudio.local_embedder is not None:
+        memory.embedding_model = LMStudioEmbedder(lmstudio)
     print("[OK] Mem0 initialized with LM Studio!")
     print()
 except Exception as e:
@@ -270,186 +367,246 @@ class LMStudioHandler(BaseHTTPRequestHandler):
         "http://localhost:7345",
         "chrome-extension://*",
     ]
+    # Split once: exact origins for a set lookup, "/*" entries as prefixes
+    _EXACT_ORIGINS = frozenset(o for o in ALLOWED_ORIGINS if not o.endswith('/*'))
+    _ORIGIN_PREFIXES = tuple(o[:-1] for o in ALLOWED_ORIGINS if o.endswith('/*'))
+    # CORS headers that don't depend on the request
+    _CORS_HEADERS = (
+        ("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS"),
+        ("Access-Control-Allow-Headers", "Content-Type, Authorization"),
+        ("Access-Control-Allow-Credentials", "true"),
+    )
+    # /health body minus its closing brace; only the timestamp changes
+    _HEALTH_PREFIX = dump_json({
+        "status": "ok",
+        "lm_studio_url": LM_STUDIO_URL,
+        "lfm2_model": lmstudio.lfm2_model,
+        "embedding_model": lmstudio.embedding_model,
+    })[:-1]
     
     def log_message(self, format, *args):
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] {format % args}")
+        logger.info(format, *args)
     
     def _get_origin(self):
         return self.headers.get('Origin', '')
     
     def _is_allowed_origin(self, origin):
-        if not origin:
-            return True
-        for allowed in self.ALLOWED_ORIGINS:
-            if allowed.endswith('/*'):
-                if origin.startswith(allowed[:-1]):
-                    return True
-            elif origin == allowed:
-                return True
-        return False
+        return (not origin or origin in self._EXACT_ORIGINS
+                or origin.startswith(self._ORIGIN_PREFIXES))
     
-    def send_json(self, data, status=200):
+    def _send_cors_headers(self):
+        """Send CORS headers if the request's origin is allowed."""
         origin = self._get_origin()
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
         if self._is_allowed_origin(origin):
             self.send_header("Access-Control-Allow-Origin", origin if origin else "http://localhost:3000")
-            self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
-            self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
-            self.send_header("Access-Control-Allow-Credentials", "true")
+            for name, value in self._CORS_HEADERS:
+                self.send_header(name, value)
+    
+    def send_json(self, data, status=200):
+        self.send_raw_json(dump_json(data), status)
+    
+    def send_raw_json(self, body: bytes, status=200):
+        """Send an already-encoded JSON body."""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self._send_cors_headers()
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
+    
+    def proxy_stream(self, url: str, body: bytes):
+        """Relay LM Studio's SSE stream to the client as tokens arrive.
+        
+        The handler speaks HTTP/1.0, so closing the connection ends the body.
+        """
+        with lmstudio.session.post(
+            url, data=body, headers={"Content-Type": "application/json"}, stream=True, timeout=60
+        ) as resp:
+            self.send_response(resp.status_code)
+            self.send_header("Content-Type", resp.headers.get("Content-Type", "text/event-stream"))
+            self.send_header("Cache-Control", "no-cache")
+            self._send_cors_headers()
+            self.end_headers()
+            try:
+                for chunk in resp.iter_content(chunk_size=None):
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                logger.info("[INFO] Client disconnected during streaming")
+            except requests.exceptions.RequestException as e:
+                # Headers are already out; all we can do is end the stream
+                logger.error(f"[ERROR] Chat stream from LM Studio: {e}")
     
     def do_OPTIONS(self):
-        origin = self._get_origin()
         self.send_response(200)
-        if self._is_allowed_origin(origin):
-            self.send_header("Access-Control-Allow-Origin", origin if origin else "http://localhost:3000")
-            self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
-            self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
-            self.send_header("Access-Control-Allow-Credentials", "true")
+        self._send_cors_headers()
         self.end_headers()
     
     def do_GET(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        query = parse_qs(parsed.query)
-        
-        # Health check
-        if path == "/health":
-            self.send_json({
-                "status": "ok",
-                "lm_studio_url": LM_STUDIO_URL,
-                "lfm2_model": lmstudio.lfm2_model,
-                "embedding_model": lmstudio.embedding_model,
-                "timestamp": datetime.now().isoformat(),
-            })
-            return
-        
-        # Get memories
-        if path == "/v1/memories/":
-            try:
-                user_id = query.get("user_id", ["default_user"])[0]
-                agent_id = query.get("agent_id", [""])[0] or None
-                limit = int(query.get("limit", ["10"])[0])
-                
-                results = memory.get_all(user_id=user_id, agent_id=agent_id, limit=limit)
-                
-                # Format results
-                memories = []
-                if isinstance(results, list):
-                    memories = results
-                elif isinstance(results, dict) and "results" in results:
-                    memories = results["results"]
-                
-                self.send_json(memories)
-            except Exception as e:
-                print(f"[ERROR] Get memories: {e}")
-                self.send_json({"error": str(e)}, 500)
+        path, _, query_string = self.path.partition("?")
+        handler = self.GET_ROUTES.get(path)
+        if handler is None:
+            self.send_json({"error": "Not found"}, 404)
             return
-        
-        self.send_json({"error": "Not found"}, 404)
+        handler(self, query_string)
     
     def do_POST(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        
         content_length = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(content_length).decode()
-        data = json.loads(body) if body else {}
-        
-        # Embeddings endpoint
-        if path == "/v1/embeddings":
-            try:
-                input_texts = data.get("input", [])
-                if isinstance(input_texts, str):
-                    input_texts = [input_texts]
-                
-                embeddings = lmstudio.embed(input_texts)
-                
-                self.send_json({
-                    "object": "list",
-                    "data": [
-                        {"object": "embedding", "embedding": emb, "index": i}
-                        for i, emb in enumerate(embeddings)
-                    ],
-                    "model": lmstudio.embedding_model or "unknown",
-                })
-            except Exception as e:
-                print(f"[ERROR] Embeddings: {e}")
-                self.send_json({"error": str(e)}, 500)
+        if content_length > MAX_BODY_BYTES:
+            self.send_json({"error": "Request body too large", "max_bytes": MAX_BODY_BYTES}, 413)
             return
-        
-        # Chat completions (passthrough to LM Studio)
-        if path == "/v1/chat/completions":
-            try:
-                url = f"{LM_STUDIO_URL}/chat/completions"
-                resp = requests.post(url, json=data, timeout=60)
-                self.send_json(resp.json(), resp.status_code)
-            except Exception as e:
-                self.send_json({"error": str(e)}, 500)
-            return
-        
-        # Add memory
-        if path == "/v1/memories/":
-            try:
-                messages = data.get("messages", [])
-                user_id = data.get("user_id", "default_user")
-                agent_id = data.get("agent_id")
-                metadata = data.get("metadata", {})
-                
-                # Add to Mem0 (uses LFM2 via LM Studio for extraction)
-                result = memory.add(
-                    messages=messages,
-                    user_id=user_id,
-                    agent_id=agent_id,
-                    metadata=metadata,
-                    infer=True  # Use LFM2 to extract facts
-                )
-                
-                self.send_json(result, 201)
-            except Exception as e:
-                print(f"[ERROR] Add memory: {e}")
-                import traceback
-                traceback.print_exc()
-                self.send_json({"error": str(e)}, 500)
-            return
-        
-        # Search memories
-        if path == "/v1/memories/search/":
-            try:
-                query = data.get("query", "")
-                user_id = data.get("user_id", "default_user")
-                agent_id = data.get("agent_id")
-                limit = data.get("limit", 10)
-                
-                results = memory.search(
-                    query=query,
-                    user_id=user_id,
-                    agent_id=agent_id,
-                    limit=limit
-                )
-                
-                self.send_json({"results": results if isinstance(results, list) else []})
-            except Exception as e:
-                print(f"[ERROR] Search: {e}")
-                self.send_json({"error": str(e)}, 500)
+        body = self.rfile.read(content_length)
+        handler = self.POST_ROUTES.get(self.path.partition("?")[0])
+        if handler is None:
+            self.send_json({"error": "Not found"}, 404)
             return
-        
-        self.send_json({"error": "Not found"}, 404)
+        # Raw body too: the chat passthrough forwards it unparsed
+        handler(self, load_json(body) if body else {}, body)
     
     def do_DELETE(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        
-        if path.startswith("/v1/memories/"):
-            try:
-                self.send_json({"deleted": True})
-            except Exception as e:
-                self.send_json({"error": str(e)}, 500)
+        # Deletion is not implemented; acknowledge without parsing the URL
+        if self.path.startswith("/v1/memories/"):
+            self.send_json({"deleted": True})
             return
-        
         self.send_json({"error": "Not found"}, 404)
+    
+    # Health check
+    def _handle_health(self, query_string):
+        timestamp = datetime.now().isoformat().encode()
+        self.send_raw_json(self._HEALTH_PREFIX + b',"timestamp":"' + timestamp + b'"}')
+    
+    # Get memories
+    def _handle_list(self, query_string):
+        try:
+            query = parse_qs(query_string)
+            user_id = query.get("user_id", ["default_user"])[0]
+            agent_id = query.get("agent_id", [""])[0] or None
+            limit = int(query.get("limit", ["10"])[0])
+            
+            results = memory.get_all(user_id=user_id, agent_id=agent_id, limit=limit)
+            
+            # Format results
+            memories = []
+            if isinstance(results, list):
+                memories = results
+            elif isinstance(results, dict) and "results" in results:
+                memories = results["results"]
+            
+            self.send_json(memories)
+        except Exception as e:
+            logger.error(f"[ERROR] Get memories: {e}")
+            self.send_json({"error": str(e)}, 500)
+    
+    # Embeddings endpoint
+    def _handle_embeddings(self, data, body):
+        try:
+            input_texts = data.get("input", [])
+            if isinstance(input_texts, str):
+                input_texts = [input_texts]
+            if len(input_texts) > MAX_EMBED_BATCH:
+                self.send_json({"error": "batch too large", "max": MAX_EMBED_BATCH}, 413)
+                return
+            
+            embeddings = lmstudio.embed(input_texts)
+            
+            self.send_json({
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "embedding": emb, "index": i}
+                    for i, emb in enumerate(embeddings)
+                ],
+                "model": lmstudio.embedding_model or "unknown",
+            })
+        except Exception as e:
+            logger.error(f"[ERROR] Embeddings: {e}")
+            self.send_json({"error": str(e)}, 500)
+    
+    # Chat completions (passthrough to LM Studio)
+    def _handle_chat(self, data, body):
+        try:
+            url = f"{LM_STUDIO_URL}/chat/completions"
+            if data.get("stream"):
+                self.proxy_stream(url, body)
+                return
+            resp = lmstudio.session.post(
+                url, data=body, headers={"Content-Type": "application/json"}, timeout=60
+            )
+            # Relay LM Studio's body as-is rather than parsing and re-encoding it
+            self.send_raw_json(resp.content, resp.status_code)
+        except Exception as e:
+            self.send_json({"error": str(e)}, 500)
+    
+    # Add memory
+    def _handle_add(self, data, body):
+        try:
+            messages = data.get("messages", [])
+            user_id = data.get("user_id", "default_user")
+            agent_id = data.get("agent_id")
+            metadata = data.get("metadata", {})
+            
+            # Add to Mem0 (uses LFM2 via LM Studio for extraction)
+            result = memory.add(
+                messages=messages,
+                user_id=user_id,
+                agent_id=agent_id,
+                metadata=metadata,
+                infer=True  # Use LFM2 to extract facts
+            )
+            
+            self.send_json(result, 201)
+        except Exception as e:
+            logger.exception(f"[ERROR] Add memory: {e}")
+            self.send_json({"error": str(e)}, 500)
+    
+    # Search memories
+    def _handle_search(self, data, body):
+        try:
+            query = data.get("query", "")
+            user_id = data.get("user_id", "default_user")
+            agent_id = data.get("agent_id")
+            limit = data.get("limit", 10)
+            
+            results = memory.search(
+                query=query,
+                user_id=user_id,
+                agent_id=agent_id,
+                limit=limit
+            )
+            
+            self.send_json({"results": results if isinstance(results, list) else []})
+        except Exception as e:
+            logger.error(f"[ERROR] Search: {e}")
+            self.send_json({"error": str(e)}, 500)
+    
+    # Exact-path dispatch tables; query strings are parsed only where used
+    GET_ROUTES = {
+        "/health": _handle_health,
+        "/v1/memories/": _handle_list,
+    }
+    POST_ROUTES = {
+        "/v1/embeddings": _handle_embeddings,
+        "/v1/chat/completions": _handle_chat,
+        "/v1/memories/": _handle_add,
+        "/v1/memories/search/": _handle_search,
+    }
+
+
+class PooledHTTPServer(ThreadingHTTPServer):
+    """Threaded server that runs requests on a fixed-size worker pool."""
+    daemon_threads = True
+    request_queue_size = 128
+    
+    def __init__(self, server_address, handler_class, max_workers: int = MEM0_WORKERS):
+        super().__init__(server_address, handler_class)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mem0")
+    
+    def process_request(self, request, client_address):
+        # Same per-request body ThreadingMixIn runs, minus a new thread each time
+        self._pool.submit(self.process_request_thread, request, client_address)
+    
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
 
 
 def main():
@@ -473,13 +630,15 @@ def main():
     print("Press Ctrl+C to stop")
     print()
     
-    server = HTTPServer((HOST, PORT), LMStudioHandler)
+    # A slow add (LFM2 extraction + embedding) no longer blocks /health
+    server = PooledHTTPServer((HOST, PORT), LMStudioHandler)
     
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("\n[INFO] Shutting down...")
         server.shutdown()
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -7,16 +7,22 @@ instead of requiring LM Studio or external API services.
 
 Models:
 - LLM: LFM-2-Vision-450M (local)
-- Embeddings: Google Embedding Gemma 300M FP8 (local, GPU required)
+- Embeddings: Google Embedding Gemma 300M FP8 (local; GPU, or CPU via ONNX Runtime int8)
 - Vector Store: Qdrant (local storage)
 
 Environment Variables:
 - MEM0_HOST: Server host (default: localhost)
 - MEM0_PORT: Server port (default: 8000)
 - MODELS_DIR: Directory to store downloaded models (default: ./models)
+- QDRANT_URL: Qdrant server URL (default: embedded ./qdrant_storage)
+- MEM0_PROCESSES: Server processes sharing the port (default: 1; Linux + QDRANT_URL)
+- MEM0_WORKER_GPUS: Comma-separated CUDA devices handed out to those processes
+- MEM0_MAX_BODY_BYTES: Largest accepted request body (default: 8 MiB)
+- MEM0_MAX_EMBED_BATCH: Most inputs per /v1/embeddings request (default: 64)
+- GPU_CONCURRENCY: Embedding/chat forward passes run at once (default: 1)
 
 Requirements:
-    - GPU is required for embedding model
+    - GPU for the embedding model, or optimum[onnxruntime] to run it int8 on CPU
     - Run `huggingface-cli login` before first use
 
 Usage:
@@ -34,11 +40,29 @@ import uuid
 import time
 import io
 import base64
+import queue
+import hashlib
+import socket
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict
 from datetime import datetime
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import parse_qs, urlparse
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional
+
+from _embed_shared import DiskEmbeddingCache, load_onnx_int8, pool_and_normalize
+
+# orjson is optional: faster JSON and native NumPy array serialization
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    orjson = None
+    HAS_ORJSON = False
 
 # Load environment variables from .env file
 try:
@@ -52,6 +76,109 @@ except ImportError:
 HOST = os.getenv("MEM0_HOST", "localhost")
 PORT = int(os.getenv("MEM0_PORT", "8000"))
 MODELS_DIR = Path(os.getenv("MODELS_DIR", "./models"))
+# Qdrant server URL; when unset vectors live in embedded ./qdrant_storage
+QDRANT_URL = os.getenv("QDRANT_URL", "")
+# Server processes bound to PORT with SO_REUSEPORT, each with its own models
+MEM0_PROCESSES = int(os.getenv("MEM0_PROCESSES", "1"))
+# Set by the launcher in each of those processes
+WORKER_INDEX = os.getenv("MEM0_WORKER_INDEX")
+# Model calls beyond this wait their turn instead of contending for the GPU
+GPU_CONCURRENCY = int(os.getenv("GPU_CONCURRENCY", "1"))
+# Largest request body accepted; bigger ones get a 413 before being read
+MAX_BODY_BYTES = int(os.getenv("MEM0_MAX_BODY_BYTES", str(8 * 1024 * 1024)))
+# Most texts one /v1/embeddings request may carry
+MAX_EMBED_BATCH = int(os.getenv("MEM0_MAX_EMBED_BATCH", "64"))
+# Texts per embedding forward pass
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+# How long the first embed request waits for others to share its forward pass
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+# Prompts per chat generate() call, and how long the first waits for company
+CHAT_BATCH_SIZE = int(os.getenv("CHAT_BATCH_SIZE", "8"))
+CHAT_BATCH_WAIT_MS = float(os.getenv("CHAT_BATCH_WAIT_MS", "10"))
+# torch.compile the embedding model (fused kernels, CUDA graph replay)
+EMBED_COMPILE = os.getenv("EMBED_COMPILE", "1") == "1"
+# Token lengths embedding batches are padded up to: short texts aren't padded
+# to a long neighbour, and the compiled model sees a few fixed shapes
+EMBED_LENGTH_BUCKETS = (128, 512, 2048, 8192)
+# Length buckets whose CUDA graphs are recorded at startup, one per
+# power-of-two batch size; longer buckets are recorded on first use
+EMBED_GRAPH_BUCKETS = (128, 512)
+# Greedy (temperature 0) chat completions kept for identical requests (0 disables)
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "256"))
+# Seconds a /health body is reused before its timestamp is refreshed
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", "1"))
+# Recent text -> embedding pairs kept in memory (0 disables)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+# Persistent text-hash -> vector cache shared across restarts ("" disables)
+EMBED_DISK_CACHE_DIR = os.getenv("EMBED_DISK_CACHE_DIR", str(MODELS_DIR / "embedding-cache"))
+# Recent searches reused for near-duplicate queries (0 disables)
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1024"))
+# Cosine similarity at which two queries count as the same search
+SEMANTIC_THRESHOLD = float(os.getenv("SEMANTIC_THRESHOLD", "0.97"))
+
+if MEM0_PROCESSES > 1:
+    # Embedded Qdrant storage can only be opened by one process, and only
+    # Linux balances connections across sockets sharing a port
+    if not QDRANT_URL or not sys.platform.startswith("linux"):
+        print("[WARN] MEM0_PROCESSES needs Linux and QDRANT_URL; running one process")
+        MEM0_PROCESSES = 1
+    else:
+        # An add in one process can't invalidate another's cached searches
+        SEMANTIC_CACHE_SIZE = 0
+
+# Per-request logs go through a queue to one writer thread, so handler
+# threads don't serialize on the stdout lock
+_log_queue: "queue.Queue" = queue.Queue()
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", datefmt="%H:%M:%S"))
+log_listener = QueueListener(_log_queue, _log_stream)
+log_listener.start()
+logger = logging.getLogger("mem0_local")
+logger.addHandler(QueueHandler(_log_queue))
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+
+def dump_json(data: Any) -> bytes:
+    """Serialize a response body, passing NumPy arrays through natively."""
+    if HAS_ORJSON:
+        # Non-string keys are stringified, as json.dumps would
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=lambda o: o.tolist()).encode()
+
+
+def load_json(body: bytes) -> Any:
+    """Parse a request body."""
+    return orjson.loads(body) if HAS_ORJSON else json.loads(body)
+
+
+def run_worker_processes() -> int:
+    """Start MEM0_PROCESSES copies of this server on PORT and wait for them.
+    
+    Each is a fresh interpreter rather than a fork, so it gets its own
+    models, batcher threads and CUDA context.
+    """
+    import subprocess
+    
+    gpus = [g for g in os.getenv("MEM0_WORKER_GPUS", "").split(",") if g]
+    workers = []
+    for index in range(MEM0_PROCESSES):
+        env = dict(os.environ, MEM0_WORKER_INDEX=str(index))
+        if gpus:
+            env["CUDA_VISIBLE_DEVICES"] = gpus[index % len(gpus)]
+        workers.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:], env=env))
+    print(f"[OK] Started {MEM0_PROCESSES} server processes on port {PORT}")
+    try:
+        return max(w.wait() for w in workers)
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the workers too; let them shut down cleanly
+        return max(w.wait() for w in workers)
+
+
+# The launcher only supervises; it never loads models itself
+if __name__ == "__main__" and MEM0_PROCESSES > 1 and WORKER_INDEX is None:
+    sys.exit(run_worker_processes())
+
 
 print("="*70)
 print("Mem0 REST API Server (Local Models - No External Dependencies)")
@@ -71,6 +198,20 @@ class LocalModelManager:
         self.llm_model = None
         self.llm_processor = None
         self.device = "cpu"
+        # Held around every forward pass; CPU-only endpoints never wait on it
+        self.gpu_slots = threading.Semaphore(GPU_CONCURRENCY)
+        self._pool = pool_and_normalize
+        # Pinned host buffers per padded (rows, length) shape, each with the
+        # event marking when its last copy to the GPU finished
+        self._pinned: Dict[tuple, tuple] = {}
+        # Mem0 re-embeds the same queries and memories constantly
+        self._embed_cache: "OrderedDict[bytes, Any]" = OrderedDict()
+        self._embed_cache_lock = threading.Lock()
+        # Behind the LRU; also guarded by _embed_cache_lock
+        self.disk_cache: Optional[DiskEmbeddingCache] = None
+        # Only greedy completions are cached: sampled ones are meant to vary
+        self._chat_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self._chat_cache_lock = threading.Lock()
         
         # Try CUDA
         try:
@@ -84,7 +225,7 @@ class LocalModelManager:
             pass
     
     def load_embedding_model(self):
-        """Load Google Embedding Gemma model (GPU required)."""
+        """Load Google Embedding Gemma model (FP16 on GPU, ONNX Runtime int8 on CPU)."""
         from transformers import AutoTokenizer, AutoModel
         import torch
         
@@ -112,24 +253,55 @@ class LocalModelManager:
                 print("[INFO] Note: You must run `huggingface-cli login` first")
                 sys.exit(1)
         
-        # GPU check for embedding model
-        if self.device != "cuda":
-            print("[ERROR] GPU is required for embedding model (google/embeddinggemma-300m-f8)")
-            print("[INFO] Please ensure CUDA is available or use a different embedding model")
-            sys.exit(1)
-        
         print(f"[INFO] Loading Google Embedding Gemma 300M FP8 model...")
         
         self.embedding_tokenizer = AutoTokenizer.from_pretrained(
             model_path, trust_remote_code=True, local_files_only=True
         )
-        self.embedding_model = AutoModel.from_pretrained(
-            model_path, trust_remote_code=True, local_files_only=True,
-            torch_dtype=torch.float16,
-            device_map="auto"
-        )
-        self.embedding_model.to(self.device)
-        self.embedding_model.eval()
+        if self.device == "cuda":
+            self.embedding_model = AutoModel.from_pretrained(
+                model_path, trust_remote_code=True, local_files_only=True,
+                torch_dtype=torch.float16,
+                device_map="auto"
+            )
+            self.embedding_model.to(self.device)
+            self.embedding_model.eval()
+            cache_name = model_path.name
+        else:
+            # FP32 torch on CPU is too slow to serve; int8 matmuls use VNNI
+            try:
+                self.embedding_model = load_onnx_int8(model_path)
+            except ImportError:
+                print("[ERROR] Embedding model needs a GPU, or optimum[onnxruntime] to run on CPU")
+                print("[INFO] Please ensure CUDA is available or run: pip install optimum[onnxruntime]")
+                sys.exit(1)
+            print(f"[OK] Using ONNX Runtime int8 for embeddings")
+            cache_name = f"{model_path.name}-onnx-int8"
+        
+        if self.disk_cache is None and EMBED_DISK_CACHE_DIR:
+            # One cache per model; vectors from another model are not comparable
+            cache_dir = Path(EMBED_DISK_CACHE_DIR) / cache_name
+            if WORKER_INDEX is not None:
+                # Memmap rows are allocated per process, so processes can't share one
+                cache_dir = cache_dir / f"worker-{WORKER_INDEX}"
+            try:
+                self.disk_cache = DiskEmbeddingCache(cache_dir, 768)
+                print(f"[OK] Embedding disk cache: {self.disk_cache.size} vectors in {cache_dir}")
+            except Exception as e:
+                print(f"[WARN] Embedding disk cache disabled: {e}")
+        
+        if EMBED_COMPILE and self.device == "cuda":
+            try:
+                import torch._dynamo
+                torch._dynamo.config.suppress_errors = True
+                self.embedding_model = torch.compile(
+                    self.embedding_model, mode="reduce-overhead", fullgraph=False
+                )
+                # Mask, weighted sum and normalize fused into one kernel
+                self._pool = torch.compile(pool_and_normalize, dynamic=False)
+                print(f"[OK] Embedding model compiled")
+            except Exception as e:
+                print(f"[WARN] torch.compile unavailable, running eagerly: {e}")
         
         print(f"[OK] Embedding model loaded")
     
@@ -168,12 +340,90 @@ class LocalModelManager:
         self.llm_model = AutoModelForVision2Seq.from_pretrained(
             model_path, trust_remote_code=True, local_files_only=True
         )
+        # Batched generation appends new tokens on the right, so pad prompts on the left
+        self.llm_processor.tokenizer.padding_side = "left"
         self.llm_model.to(self.device)
         self.llm_model.eval()
         
         print(f"[OK] LLM model loaded")
     
-    def embed(self, texts: List[str]) -> List[List[float]]:
+    @staticmethod
+    def _cache_key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
+    
+    def lookup(self, texts: List[str]):
+        """Cached embeddings for texts as an (n, 768) array, or None if any is missing."""
+        import numpy as np
+        
+        keys = [self._cache_key(t) for t in texts]
+        with self._embed_cache_lock:
+            if not keys or not all(k in self._embed_cache for k in keys):
+                return None
+            for k in keys:
+                self._embed_cache.move_to_end(k)
+            return np.stack([self._embed_cache[k] for k in keys])
+    
+    def embed(self, texts: List[str]):
+        """Embed texts into an (n, 768) float32 array, running only cache misses through the model."""
+        import numpy as np
+        
+        if not texts:
+            return np.zeros((0, 768), dtype=np.float32)
+        keys = [self._cache_key(t) for t in texts]
+        with self._embed_cache_lock:
+            results = [self._embed_cache.get(k) for k in keys]
+            for k, r in zip(keys, results):
+                if r is not None:
+                    self._embed_cache.move_to_end(k)
+        # Embed each distinct missing text once, even if repeated in the batch
+        misses: Dict[bytes, str] = {}
+        for k, t, r in zip(keys, texts, results):
+            if r is None:
+                misses.setdefault(k, t)
+        computed: Dict[bytes, Any] = {}
+        if misses and self.disk_cache is not None:
+            with self._embed_cache_lock:
+                computed = self.disk_cache.get_many(list(misses))
+            for k in computed:
+                del misses[k]
+        if misses:
+            fresh = dict(zip(misses, self._embed_uncached(list(misses.values()))))
+            computed.update(fresh)
+            if self.disk_cache is not None:
+                with self._embed_cache_lock:
+                    self.disk_cache.put_many(list(fresh.items()))
+        if computed:
+            results = [r if r is not None else computed[k] for k, r in zip(keys, results)]
+            if EMBED_CACHE_SIZE > 0:
+                with self._embed_cache_lock:
+                    self._embed_cache.update(computed)
+                    while len(self._embed_cache) > EMBED_CACHE_SIZE:
+                        self._embed_cache.popitem(last=False)
+        return np.stack(results)
+    
+    def capture_embedding_graphs(self):
+        """Record the compiled embedder's CUDA graphs for the common shapes.
+        
+        With mode="reduce-overhead" the first calls at each shape capture a
+        CUDA graph that later calls replay, so no real request pays for it.
+        Graphs belong to the recording thread: run this on the batcher's.
+        """
+        if not EMBED_COMPILE or self.device != "cuda":
+            return
+        sizes = []
+        size = 1
+        while size <= EMBED_BATCH_SIZE:
+            sizes.append(size)
+            size *= 2
+        # Word counts that tokenize into each bucket
+        samples = {128: "warmup", 512: " ".join(["warmup"] * 200)}
+        for bucket in EMBED_GRAPH_BUCKETS:
+            for size in sizes:
+                for _ in range(3):
+                    self._embed_uncached([samples[bucket]] * size)
+        print(f"[OK] Embedding CUDA graphs recorded for {len(sizes) * len(EMBED_GRAPH_BUCKETS)} shapes")
+    
+    def _embed_uncached(self, texts: List[str]):
         """Generate embeddings for texts using Gemma model."""
         import torch
         
@@ -183,37 +433,77 @@ class LocalModelManager:
         # Gemma doesn't use task prefixes like Nomic
         # Just use raw texts
         
-        embeddings = []
-        batch_size = 8
-        
-        with torch.no_grad():
-            for i in range(0, len(texts), batch_size):
-                batch = texts[i:i + batch_size]
-                
-                # Gemma supports up to 8192 tokens
-                encoded = self.embedding_tokenizer(
-                    batch, padding=True, truncation=True,
-                    return_tensors="pt", max_length=8192
-                )
-                encoded = {k: v.to(self.device) for k, v in encoded.items()}
-                
-                output = self.embedding_model(**encoded)
-                
-                # Mean pooling (Gemma uses similar pooling strategy)
-                mask = encoded["attention_mask"].unsqueeze(-1).float()
-                embeddings_batch = (output[0] * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
-                embeddings_batch = torch.nn.functional.normalize(embeddings_batch, p=2, dim=1)
-                
-                embeddings.extend(embeddings_batch.cpu().numpy().tolist())
-        
-        return embeddings
-    
-    def chat(self, messages: List[Dict[str, Any]], max_tokens: int = 512) -> str:
-        """Generate chat completion."""
-        if self.llm_model is None:
-            self.load_llm_model()
+        # Tokenize once unpadded (Gemma supports up to 8192 tokens), then
+        # group texts by the smallest bucket that holds them
+        features = self.embedding_tokenizer(
+            texts, truncation=True, max_length=EMBED_LENGTH_BUCKETS[-1]
+        )
+        buckets: Dict[int, List[int]] = {}
+        for i, ids in enumerate(features["input_ids"]):
+            bucket = next(b for b in EMBED_LENGTH_BUCKETS if b >= len(ids))
+            buckets.setdefault(bucket, []).append(i)
+        
+        # Batches stay on the device; one copy to the host at the end
+        chunks = []
+        order: List[int] = []
+        batch_size = EMBED_BATCH_SIZE
+        
+        with self.gpu_slots, torch.inference_mode():
+            for bucket, indices in sorted(buckets.items()):
+                for start in range(0, len(indices), batch_size):
+                    batch = indices[start:start + batch_size]
+                    # Round rows up to a power of two by repeating the last
+                    # text, so every call replays one of a few graphs
+                    rows = len(batch)
+                    padded = batch + [batch[-1]] * (min(1 << (rows - 1).bit_length(), batch_size) - rows)
+                    encoded = self.embedding_tokenizer.pad(
+                        {k: [features[k][i] for i in padded] for k in features.keys()},
+                        padding="max_length", max_length=bucket, return_tensors="pt",
+                    )
+                    encoded = self._to_device(encoded)
+                    
+                    output = self.embedding_model(**encoded)
+                    
+                    # Mean pooling (Gemma uses similar pooling strategy), in
+                    # FP16 as one contraction rather than mask/sum/divide passes
+                    embeddings_batch = self._pool(output[0], encoded["attention_mask"])
+                    
+                    chunks.append(embeddings_batch[:rows])
+                    order.extend(batch)
+            
+            # Rows come out grouped by bucket; scatter them back to input order
+            grouped = torch.cat(chunks)
+            embeddings = torch.empty_like(grouped)
+            embeddings[torch.tensor(order, device=grouped.device)] = grouped
+            return embeddings.float().cpu().numpy()
+    
+    def _to_device(self, encoded) -> Dict[str, Any]:
+        """Move a padded batch to the GPU through reused pinned buffers.
         
-        # Convert messages to simple text prompt
+        Copies from pinned memory are DMA transfers that run asynchronously,
+        overlapping with the previous batch's forward pass.
+        """
+        import torch
+        
+        if self.device != "cuda":
+            return dict(encoded)
+        key = tuple(encoded["input_ids"].shape)
+        if key not in self._pinned:
+            buffers = {k: torch.empty(v.shape, dtype=v.dtype).pin_memory() for k, v in encoded.items()}
+            self._pinned[key] = (buffers, torch.cuda.Event())
+        buffers, copied = self._pinned[key]
+        # Don't overwrite a buffer the GPU may still be reading from
+        copied.synchronize()
+        on_device = {}
+        for k, v in encoded.items():
+            buffers[k].copy_(v)
+            on_device[k] = buffers[k].to(self.device, non_blocking=True)
+        copied.record()
+        return on_device
+    
+    @staticmethod
+    def _chat_prompt(messages: List[Dict[str, Any]]) -> str:
+        """Flatten chat messages into the plain-text prompt the LLM expects."""
         prompt_parts = []
         for msg in messages:
             role = msg.get("role", "user")
@@ -232,33 +522,323 @@ class LocalModelManager:
                 prompt_parts.append(f"Assistant: {content}")
         
         prompt_parts.append("Assistant:")
-        prompt = "\n".join(prompt_parts)
+        return "\n".join(prompt_parts)
+    
+    @staticmethod
+    def _sampling_args(temperature: float) -> Dict[str, Any]:
+        """generate() arguments for a request temperature; 0 means greedy."""
+        if temperature <= 0:
+            return {"do_sample": False}
+        return {"do_sample": True, "temperature": temperature, "top_p": 0.9}
+    
+    @staticmethod
+    def _chat_key(messages: List[Dict[str, Any]], max_tokens: int) -> bytes:
+        # Sorted keys so field order in the request doesn't split entries
+        payload = json.dumps([messages, max_tokens], sort_keys=True).encode()
+        return hashlib.blake2b(payload, digest_size=16).digest()
+    
+    def chat_lookup(self, messages: List[Dict[str, Any]], max_tokens: int,
+                    temperature: float) -> Optional[str]:
+        """A cached greedy completion for this exact request, if any."""
+        if temperature > 0 or CHAT_CACHE_SIZE <= 0:
+            return None
+        key = self._chat_key(messages, max_tokens)
+        with self._chat_cache_lock:
+            response = self._chat_cache.get(key)
+            if response is not None:
+                self._chat_cache.move_to_end(key)
+            return response
+    
+    def chat(self, messages: List[Dict[str, Any]], max_tokens: int = 512,
+             temperature: float = 0.7) -> str:
+        """Generate chat completion."""
+        return self.chat_batch([messages], max_tokens=max_tokens, temperature=temperature)[0]
+    
+    def chat_batch(self, conversations: List[List[Dict[str, Any]]], max_tokens: int = 512,
+                   temperature: float = 0.7) -> List[str]:
+        """Generate completions for several conversations in one generate() call."""
+        if self.llm_model is None:
+            self.load_llm_model()
+        
+        prompts = [self._chat_prompt(messages) for messages in conversations]
         
         # Generate
         import torch
-        inputs = self.llm_processor(text=prompt, return_tensors="pt")
+        inputs = self.llm_processor(text=prompts, padding=True, return_tensors="pt")
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
         
-        with torch.no_grad():
+        with self.gpu_slots, torch.inference_mode():
             outputs = self.llm_model.generate(
                 **inputs,
                 max_new_tokens=max_tokens,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.9,
+                **self._sampling_args(temperature),
             )
         
-        response = self.llm_processor.decode(outputs[0], skip_special_tokens=True)
+        responses = []
+        for response in self.llm_processor.batch_decode(outputs, skip_special_tokens=True):
+            # Extract just the assistant's response
+            if "Assistant:" in response:
+                response = response.split("Assistant:")[-1].strip()
+            responses.append(response)
+        
+        if temperature <= 0 and CHAT_CACHE_SIZE > 0:
+            with self._chat_cache_lock:
+                for messages, response in zip(conversations, responses):
+                    self._chat_cache[self._chat_key(messages, max_tokens)] = response
+                while len(self._chat_cache) > CHAT_CACHE_SIZE:
+                    self._chat_cache.popitem(last=False)
+        return responses
+    
+    def chat_stream(self, messages: List[Dict[str, Any]], max_tokens: int = 512,
+                    temperature: float = 0.7) -> Iterator[str]:
+        """Yield a chat completion piece by piece as generate() decodes it.
+        
+        Closing the iterator early (client gone) stops generation at the
+        next token instead of running on to max_tokens.
+        """
+        if self.llm_model is None:
+            self.load_llm_model()
+        
+        import torch
+        from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+        
+        class StopWhenSet(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                return cancelled.is_set()
+        
+        inputs = self.llm_processor(text=self._chat_prompt(messages), return_tensors="pt")
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        streamer = TextIteratorStreamer(
+            self.llm_processor.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        cancelled = threading.Event()
+        errors: List[Exception] = []
+        
+        def generate():
+            try:
+                with self.gpu_slots, torch.inference_mode():
+                    self.llm_model.generate(
+                        **inputs,
+                        max_new_tokens=max_tokens,
+                        **self._sampling_args(temperature),
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([StopWhenSet()]),
+                    )
+            except Exception as e:
+                errors.append(e)
+                # Unblock the consumer; generate() never reached its own end()
+                streamer.end()
+        
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            for piece in streamer:
+                if piece:
+                    yield piece
+        finally:
+            cancelled.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent embed calls into shared forward passes."""
+    
+    def __init__(self, manager: LocalModelManager,
+                 max_batch: int = EMBED_BATCH_SIZE,
+                 max_wait_ms: float = EMBED_BATCH_WAIT_MS):
+        self.manager = manager
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[tuple[List[str], Future]]" = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def submit(self, texts: List[str]):
+        """Queue texts for embedding and block until their vectors are ready."""
+        # Repeats skip the batching window as well as the model
+        cached = self.manager.lookup(texts)
+        if cached is not None:
+            return cached
+        future: Future = Future()
+        self._queue.put((texts, future))
+        return future.result()
+    
+    def run_on_worker(self, job):
+        """Run job() on the batcher thread, where every forward pass happens."""
+        future: Future = Future()
+        self._queue.put((job, future))
+        return future.result()
+    
+    def _collect(self) -> List[tuple]:
+        """Wait for one request, then gather more until the batch is full or the window closes."""
+        pending = [self._queue.get()]
+        if callable(pending[0][0]):
+            return pending
+        count = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if callable(item[0]):
+                # Jobs run on their own; leave this one for the next round
+                self._queue.put(item)
+                break
+            pending.append(item)
+            count += len(item[0])
+        return pending
+    
+    def _run(self):
+        while True:
+            pending = self._collect()
+            if callable(pending[0][0]):
+                job, future = pending[0]
+                try:
+                    future.set_result(job())
+                except Exception as e:
+                    future.set_exception(e)
+                continue
+            texts = [text for batch, _ in pending for text in batch]
+            try:
+                embeddings = self.manager.embed(texts)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            
+            # Hand each caller back its own slice, in submission order
+            offset = 0
+            for batch, future in pending:
+                future.set_result(embeddings[offset:offset + len(batch)])
+                offset += len(batch)
+
+
+class ChatBatcher:
+    """Coalesces concurrent chat calls into shared generate() calls."""
+    
+    def __init__(self, manager: LocalModelManager,
+                 max_batch: int = CHAT_BATCH_SIZE,
+                 max_wait_ms: float = CHAT_BATCH_WAIT_MS):
+        self.manager = manager
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue[tuple[List[Dict[str, Any]], int, float, Future]]" = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+    
+    def submit(self, messages: List[Dict[str, Any]], max_tokens: int = 512,
+               temperature: float = 0.7) -> str:
+        """Queue a conversation and block until its completion is ready."""
+        # Repeated greedy requests skip the batching window as well as the model
+        cached = self.manager.chat_lookup(messages, max_tokens, temperature)
+        if cached is not None:
+            return cached
+        future: Future = Future()
+        self._queue.put((messages, max_tokens, temperature, future))
+        return future.result()
+    
+    def _collect(self) -> List[tuple]:
+        """Wait for one request, then gather more until the batch is full or the window closes."""
+        pending = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(pending) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+    
+    def _run(self):
+        while True:
+            # Sampling settings are shared per generate() call, so only
+            # requests asking for the same max_tokens and temperature run together
+            groups: Dict[tuple, List[tuple]] = {}
+            for item in self._collect():
+                try:
+                    groups.setdefault((item[1], item[2]), []).append(item)
+                except TypeError as e:
+                    # An unhashable setting fails its own request, not the thread
+                    item[3].set_exception(e)
+            
+            for (max_tokens, temperature), group in groups.items():
+                try:
+                    responses = self.manager.chat_batch(
+                        [item[0] for item in group], max_tokens=max_tokens, temperature=temperature
+                    )
+                except Exception as e:
+                    for item in group:
+                        item[3].set_exception(e)
+                    continue
+                for item, response in zip(group, responses):
+                    item[3].set_result(response)
+
+
+class SemanticSearchCache:
+    """Search results for recent queries, matched by embedding similarity.
+    
+    Vectors live in a float32 ring buffer, so one BLAS matmul scores every
+    entry. Any add clears the cache, since it may change the results.
+    """
+    
+    def __init__(self, size: int = SEMANTIC_CACHE_SIZE, threshold: float = SEMANTIC_THRESHOLD):
+        self.size = size
+        self.threshold = threshold
+        self._vectors = None
+        self._scopes: List[tuple] = []
+        self._results: List[Any] = []
+        self._next = 0
+        self._lock = threading.RLock()
+    
+    def get(self, vector, scope: tuple):
+        """Results of the most similar cached search in the same scope, or None."""
+        import numpy as np
         
-        # Extract just the assistant's response
-        if "Assistant:" in response:
-            response = response.split("Assistant:")[-1].strip()
+        with self._lock:
+            if not self._results:
+                return None
+            scores = self._vectors[:len(self._results)] @ np.asarray(vector, dtype=np.float32)
+            for i in np.argsort(-scores):
+                if scores[i] < self.threshold:
+                    break
+                if self._scopes[i] == scope:
+                    return self._results[i]
+        return None
+    
+    def put(self, vector, scope: tuple, results):
+        import numpy as np
         
-        return response
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.size, len(vector)), dtype=np.float32)
+            slot = self._next
+            self._vectors[slot] = vector
+            if slot < len(self._results):
+                self._scopes[slot] = scope
+                self._results[slot] = results
+            else:
+                self._scopes.append(scope)
+                self._results.append(results)
+            self._next = (slot + 1) % self.size
+    
+    def clear(self):
+        with self._lock:
+            self._scopes.clear()
+            self._results.clear()
+            self._next = 0
 
 
 # Initialize model manager
 model_manager = LocalModelManager()
+embedding_batcher = EmbeddingBatcher(model_manager)
+chat_batcher = ChatBatcher(model_manager)
+search_cache = SemanticSearchCache()
 
 # ============================================================================
 # Mem0 Integration
@@ -274,17 +854,18 @@ except ImportError:
     HAS_MEM0 = False
     Memory = None
 
-# Custom embedder and LLM classes for Mem0
+# Custom embedder and LLM classes for Mem0. They replace the OpenAI clients
+# Mem0 builds from the config, which would call this server back over HTTP.
 class LocalEmbedder:
     """Local embedding provider for Mem0."""
     
     def __init__(self):
         pass
     
-    def embed(self, text: str, memory_type: str = "text") -> List[float]:
+    def embed(self, text: str, memory_action: Optional[str] = None) -> List[float]:
         """Embed a single text."""
-        result = model_manager.embed([text])
-        return result[0] if result else []
+        # Qdrant's point model validates plain float lists, not arrays
+        return embedding_batcher.submit([text])[0].tolist()
 
 
 class LocalLLM:
@@ -292,7 +873,13 @@ class LocalLLM:
     
     def generate(self, messages: List[Dict[str, Any]], **kwargs) -> str:
         """Generate response from messages."""
-        return model_manager.chat(messages, max_tokens=kwargs.get('max_tokens', 512))
+        return chat_batcher.submit(messages, max_tokens=kwargs.get('max_tokens', 512),
+                                   temperature=kwargs.get('temperature', 0.7))
+    
+    def generate_response(self, messages: List[Dict[str, Any]], response_format=None,
+                          tools=None, tool_choice="auto") -> str:
+        """Entry point Mem0 calls for fact extraction and memory updates."""
+        return chat_batcher.submit(messages, max_tokens=512)
 
 
 # Configure Mem0
@@ -303,6 +890,7 @@ if HAS_MEM0:
     
     # Pre-load models
     model_manager.load_embedding_model()
+    embedding_batcher.run_on_worker(model_manager.capture_embedding_graphs)
     model_manager.load_llm_model()
     
     config = {
@@ -311,11 +899,11 @@ if HAS_MEM0:
             "config": {
                 "collection_name": "screen_memories",
                 "embedding_model_dims": 768,
-                "path": "./qdrant_storage",
+                **({"url": QDRANT_URL} if QDRANT_URL else {"path": "./qdrant_storage"}),
             }
         },
         "embedder": {
-            "provider": "openai",  # We'll override the embedding function
+            "provider": "openai",  # Replaced by LocalEmbedder below
             "config": {
                 "model": "nomic-embed-text-v1.5",
                 "api_key": "local",
@@ -336,7 +924,39 @@ if HAS_MEM0:
     
     try:
         memory = Memory.from_config(config_dict=config)
+        # Call the models in-process instead of looping back through
+        # /v1/embeddings and /v1/chat/completions on this same server
+        memory.embedding_model = LocalEmbedder()
+        memory.llm = LocalLLM()
         print("[OK] Mem0 initialized successfully")
+        # Store and compare vectors as int8 (a quarter of FP32's bytes);
+        # embedded (path) mode does brute-force search and ignores this
+        if QDRANT_URL:
+            try:
+                from qdrant_client import models as qm
+                memory.vector_store.client.update_collection(
+                    collection_name=memory.vector_store.collection_name,
+                    quantization_config=qm.ScalarQuantization(
+                        scalar=qm.ScalarQuantizationConfig(type=qm.ScalarType.INT8, always_ram=True)
+                    ),
+                )
+                print("[OK] Qdrant collection uses int8 scalar quantization")
+            except Exception as e:
+                print(f"[WARN] Could not enable Qdrant quantization: {e}")
+            # Mem0 already turns user_id/agent_id into Qdrant payload
+            # filters; keyword indexes let the filtered search stay on HNSW
+            # instead of scanning every point's payload
+            try:
+                from qdrant_client import models as qm
+                for field in ("user_id", "agent_id"):
+                    memory.vector_store.client.create_payload_index(
+                        collection_name=memory.vector_store.collection_name,
+                        field_name=field,
+                        field_schema=qm.PayloadSchemaType.KEYWORD,
+                    )
+                print("[OK] Qdrant payload indexes on user_id, agent_id")
+            except Exception as e:
+                print(f"[WARN] Could not create Qdrant payload indexes: {e}")
     except Exception as e:
         print(f"[WARN] Failed to initialize Mem0: {e}")
         print("       Running in API-only mode")
@@ -347,11 +967,43 @@ print()
 # HTTP Server
 # ============================================================================
 
+def _memory_row(mem, user_id: str, now_iso: str) -> Dict[str, Any]:
+    """One Mem0 result (a dict, or a bare string from older Mem0) as an API memory."""
+    if isinstance(mem, str):
+        return {"id": str(uuid.uuid4()), "content": mem, "user_id": user_id,
+                "metadata": {}, "created_at": now_iso}
+    return {
+        "id": mem.get("id") or str(uuid.uuid4()),
+        "content": mem.get("memory", mem.get("content", "")),
+        "user_id": user_id,
+        "metadata": mem.get("metadata", {}),
+        "created_at": mem.get("created_at", now_iso),
+    }
+
+
+def _search_row(r, user_id: str, now_iso: str) -> Dict[str, Any]:
+    """One Mem0 search hit as an API search result."""
+    if isinstance(r, str):
+        return {"memory": _memory_row(r, user_id, now_iso), "score": 1.0, "distance": 0.0}
+    return {
+        "memory": _memory_row(r, user_id, now_iso),
+        "score": r.get("score", 0.0),
+        "distance": r.get("distance", 0.0),
+    }
+
+
+def _result_rows(results) -> List[Any]:
+    """Mem0 result rows, whether returned bare or wrapped as {"results": [...]}."""
+    if isinstance(results, dict):
+        results = results.get("results", [])
+    return [r for r in results if isinstance(r, (dict, str))]
+
+
 class Mem0LocalHandler(BaseHTTPRequestHandler):
     """HTTP handler for Mem0 with local models."""
     
     def log_message(self, format, *args):
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] {format % args}")
+        logger.info(format, *args)
     
     # Allowed origins for CORS - configure based on your deployment
     ALLOWED_ORIGINS = [
@@ -365,6 +1017,45 @@ class Mem0LocalHandler(BaseHTTPRequestHandler):
         "https://gemini.google.com",
         "https://perplexity.ai",
     ]
+    # Split once: exact origins for a set lookup, "/*" entries as prefixes
+    _EXACT_ORIGINS = frozenset(o for o in ALLOWED_ORIGINS if not o.endswith('/*'))
+    _ORIGIN_PREFIXES = tuple(o[:-1] for o in ALLOWED_ORIGINS if o.endswith('/*'))
+    # CORS headers that don't depend on the request
+    _CORS_HEADERS = (
+        ("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS"),
+        ("Access-Control-Allow-Headers", "Content-Type, Authorization"),
+        ("Access-Control-Allow-Credentials", "true"),
+    )
+    # Keep-alive: clients reuse one connection instead of a TCP handshake
+    # per request. Every response therefore carries a Content-Length.
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes; with Nagle on, the body
+    # waits for the client's delayed ACK (~40 ms) on a kept-alive connection
+    disable_nagle_algorithm = True
+    # Each connection has its own thread; close idle ones after a few seconds
+    timeout = 5
+    # /health body minus its closing brace; only the timestamp changes
+    _HEALTH_PREFIX = dump_json({
+        "status": "ok",
+        "llm_provider": "local (lfm-2-vision-450m)",
+        "embedder_provider": "local (nomic-embed-text-v1.5)",
+        "vector_store": "qdrant" if HAS_MEM0 else "disabled",
+    })[:-1]
+    # Last /health body and when it goes stale, replaced as one tuple
+    _health_cache = (b"", 0.0)
+    # /v1/models never changes while the server runs
+    _MODELS_BODY = dump_json({
+        "object": "list",
+        "data": [
+            {
+                "id": model_id,
+                "object": "model",
+                "created": int(time.time()),
+                "owned_by": "local"
+            }
+            for model_id in ("nomic-embed-text-v1.5", "lfm-2-vision-450m")
+        ]
+    })
     
     def _get_origin(self):
         """Get the Origin header from the request."""
@@ -372,315 +1063,357 @@ class Mem0LocalHandler(BaseHTTPRequestHandler):
     
     def _is_allowed_origin(self, origin):
         """Check if the origin is in the allowed list."""
-        if not origin:
-            return True  # Same-origin requests
-        for allowed in self.ALLOWED_ORIGINS:
-            if allowed.endswith('/*'):
-                # Wildcard match for extensions
-                prefix = allowed[:-1]
-                if origin.startswith(prefix):
-                    return True
-            elif origin == allowed:
-                return True
-        return False
+        return (not origin or origin in self._EXACT_ORIGINS
+                or origin.startswith(self._ORIGIN_PREFIXES))
     
-    def send_json_response(self, data: dict, status: int = 200):
+    def _send_cors_headers(self):
+        """Send CORS headers if the request's origin is allowed."""
         origin = self._get_origin()
+        if self._is_allowed_origin(origin):
+            self.send_header("Access-Control-Allow-Origin", origin if origin else "http://localhost:3000")
+            for name, value in self._CORS_HEADERS:
+                self.send_header(name, value)
+    
+    def send_json_response(self, data: dict, status: int = 200):
+        self.send_raw_json(dump_json(data), status)
+    
+    def send_raw_json(self, body: bytes, status: int = 200):
+        """Send an already-encoded JSON body."""
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
         
         # Only set CORS headers for allowed origins
-        if self._is_allowed_origin(origin):
-            self.send_header("Access-Control-Allow-Origin", origin if origin else "http://localhost:3000")
-            self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
-            self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
-            self.send_header("Access-Control-Allow-Credentials", "true")
+        self._send_cors_headers()
         
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
     
     def do_OPTIONS(self):
-        origin = self._get_origin()
         self.send_response(200)
+        self.send_header("Content-Length", "0")
         
         # Only set CORS headers for allowed origins
-        if self._is_allowed_origin(origin):
-            self.send_header("Access-Control-Allow-Origin", origin if origin else "http://localhost:3000")
-            self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
-            self.send_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
-            self.send_header("Access-Control-Allow-Credentials", "true")
+        self._send_cors_headers()
         
         self.end_headers()
     
     def do_GET(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        query = parse_qs(parsed.query)
-        
-        # Health check
-        if path == "/health":
-            self.send_json_response({
-                "status": "ok",
-                "timestamp": datetime.now().isoformat(),
-                "llm_provider": "local (lfm-2-vision-450m)",
-                "embedder_provider": "local (nomic-embed-text-v1.5)",
-                "vector_store": "qdrant" if HAS_MEM0 else "disabled",
-            })
+        path, _, query_string = self.path.partition("?")
+        handler = self.GET_ROUTES.get(path)
+        if handler is None:
+            self.send_json_response({"error": "Not found"}, 404)
+            return
+        handler(self, query_string)
+    
+    def do_POST(self):
+        # Route first: unknown paths and oversized bodies are refused unread
+        handler = self.POST_ROUTES.get(self.path.partition("?")[0])
+        content_length = int(self.headers.get("Content-Length", 0))
+        if handler is None or content_length > MAX_BODY_BYTES:
+            # The unread body would be parsed as the next request
+            self.close_connection = True
+            if handler is None:
+                self.send_json_response({"error": "Not found"}, 404)
+            else:
+                self.send_json_response({"error": "Request body too large", "max_bytes": MAX_BODY_BYTES}, 413)
+            return
+        body = self.rfile.read(content_length)
+        handler(self, load_json(body) if body else {})
+    
+    def do_DELETE(self):
+        # Deletion is not implemented; acknowledge without parsing the URL
+        if self.path.startswith("/v1/memories/"):
+            self.send_json_response({"deleted": True})
             return
+        self.send_json_response({"error": "Not found"}, 404)
+    
+    # Health check
+    def _handle_health(self, query_string):
+        # Liveness probes arrive in floods; rebuild the body at most once a second
+        body, expires = Mem0LocalHandler._health_cache
+        now = time.monotonic()
+        if now >= expires:
+            timestamp = datetime.now().isoformat().encode()
+            body = self._HEALTH_PREFIX + b',"timestamp":"' + timestamp + b'"}'
+            Mem0LocalHandler._health_cache = (body, now + HEALTH_CACHE_TTL)
+        self.send_raw_json(body)
+    
+    # List models (OpenAI compatible)
+    def _handle_models(self, query_string):
+        self.send_raw_json(self._MODELS_BODY)
+    
+    # Get memories
+    def _handle_list(self, query_string):
+        if memory is None:
+            self.send_json_response({"error": "Not found"}, 404)
+            return
+        query = parse_qs(query_string)
+        user_id = query.get("user_id", ["default_user"])[0]
+        agent_id = query.get("agent_id", [""])[0] or None
+        limit = int(query.get("limit", ["10"])[0])
         
-        # List models (OpenAI compatible)
-        if path == "/v1/models":
-            self.send_json_response({
+        try:
+            results = memory.get_all(user_id=user_id, agent_id=agent_id, limit=limit)
+            # One timestamp per response; defaults are built only when missing
+            now_iso = datetime.now().isoformat()
+            memories = [_memory_row(mem, user_id, now_iso) for mem in _result_rows(results)]
+            
+            self.send_json_response(memories)
+        except Exception as e:
+            logger.error(f"[ERROR] Get memories failed: {e}")
+            self.send_json_response({"error": str(e)}, 500)
+    
+    # Embeddings endpoint
+    def _handle_embeddings(self, data):
+        try:
+            input_texts = data.get("input", [])
+            if isinstance(input_texts, str):
+                input_texts = [input_texts]
+            
+            if not input_texts:
+                self.send_json_response({"error": "No input provided"}, 400)
+                return
+            if len(input_texts) > MAX_EMBED_BATCH:
+                self.send_json_response({"error": "batch too large", "max": MAX_EMBED_BATCH}, 413)
+                return
+            
+            embeddings = embedding_batcher.submit(input_texts)
+            prompt_tokens = sum(len(t.split()) for t in input_texts)
+            
+            # Rows stay float32 arrays; dump_json writes them without
+            # boxing each element as a Python float
+            response = {
                 "object": "list",
                 "data": [
                     {
-                        "id": "nomic-embed-text-v1.5",
-                        "object": "model",
-                        "created": int(time.time()),
-                        "owned_by": "local"
-                    },
-                    {
-                        "id": "lfm-2-vision-450m",
-                        "object": "model",
-                        "created": int(time.time()),
-                        "owned_by": "local"
+                        "object": "embedding",
+                        "embedding": emb,
+                        "index": i
                     }
-                ]
-            })
-            return
-        
-        # Get memories
-        if path == "/v1/memories/" and HAS_MEM0 and memory:
-            user_id = query.get("user_id", ["default_user"])[0]
-            agent_id = query.get("agent_id", [""])[0] or None
-            limit = int(query.get("limit", ["10"])[0])
+                    for i, emb in enumerate(embeddings)
+                ],
+                "model": data.get("model", "nomic-embed-text-v1.5"),
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "total_tokens": prompt_tokens
+                }
+            }
             
-            try:
-                results = memory.get_all(user_id=user_id, agent_id=agent_id, limit=limit)
-                memories = []
-                
-                if isinstance(results, list):
-                    for mem in results:
-                        if isinstance(mem, dict):
-                            memories.append({
-                                "id": mem.get("id", str(uuid.uuid4())),
-                                "content": mem.get("memory", ""),
-                                "user_id": user_id,
-                                "metadata": mem.get("metadata", {}),
-                                "created_at": mem.get("created_at", datetime.now().isoformat())
-                            })
-                        elif isinstance(mem, str):
-                            memories.append({
-                                "id": str(uuid.uuid4()),
-                                "content": mem,
-                                "user_id": user_id,
-                                "metadata": {},
-                                "created_at": datetime.now().isoformat()
-                            })
-                elif isinstance(results, dict) and "results" in results:
-                    for mem in results["results"]:
-                        memories.append({
-                            "id": mem.get("id", str(uuid.uuid4())),
-                            "content": mem.get("memory", mem.get("content", "")),
-                            "user_id": user_id,
-                            "metadata": mem.get("metadata", {}),
-                            "created_at": mem.get("created_at", datetime.now().isoformat())
-                        })
-                
-                self.send_json_response(memories)
-            except Exception as e:
-                print(f"[ERROR] Get memories failed: {e}")
-                self.send_json_response({"error": str(e)}, 500)
-            return
-        
-        self.send_json_response({"error": "Not found"}, 404)
+            self.send_json_response(response)
+        except Exception as e:
+            logger.exception(f"[ERROR] Embeddings failed: {e}")
+            self.send_json_response({"error": str(e)}, 500)
     
-    def do_POST(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        
-        content_length = int(self.headers.get("Content-Length", 0))
-        body = self.rfile.read(content_length).decode()
-        data = json.loads(body) if body else {}
-        
-        # Embeddings endpoint
-        if path == "/v1/embeddings":
+    # Chat completions endpoint
+    def _handle_chat(self, data):
+        try:
+            messages = data.get("messages", [])
+            max_tokens = data.get("max_tokens")
+            temperature = data.get("temperature")
+            
+            if not messages:
+                self.send_json_response({"error": "No messages provided"}, 400)
+                return
+            if not isinstance(messages, list) or not all(isinstance(m, dict) for m in messages):
+                self.send_json_response({"error": "messages must be a list of objects"}, 400)
+                return
+            # Validated here so a bad request can't fail a batch it shares
             try:
-                input_texts = data.get("input", [])
-                if isinstance(input_texts, str):
-                    input_texts = [input_texts]
-                
-                if not input_texts:
-                    self.send_json_response({"error": "No input provided"}, 400)
-                    return
-                
-                embeddings = model_manager.embed(input_texts)
-                
-                response = {
-                    "object": "list",
-                    "data": [
-                        {
-                            "object": "embedding",
-                            "embedding": emb,
-                            "index": i
-                        }
-                        for i, emb in enumerate(embeddings)
-                    ],
-                    "model": data.get("model", "nomic-embed-text-v1.5"),
-                    "usage": {
-                        "prompt_tokens": sum(len(t.split()) for t in input_texts),
-                        "total_tokens": sum(len(t.split()) for t in input_texts)
+                max_tokens = 512 if max_tokens is None else int(max_tokens)
+                temperature = 0.7 if temperature is None else float(temperature)
+            except (TypeError, ValueError):
+                self.send_json_response({"error": "max_tokens must be an integer and temperature a number"}, 400)
+                return
+            if max_tokens < 1:
+                self.send_json_response({"error": "max_tokens must be at least 1"}, 400)
+                return
+            
+            if data.get("stream"):
+                self._stream_chat(messages, max_tokens, temperature, data.get("model", "lfm-2-vision-450m"))
+                return
+            
+            response_text = chat_batcher.submit(messages, max_tokens=max_tokens, temperature=temperature)
+            
+            response = {
+                "id": f"chatcmpl-{int(time.time())}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": data.get("model", "lfm-2-vision-450m"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": response_text
+                        },
+                        "finish_reason": "stop"
                     }
+                ],
+                "usage": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "total_tokens": 0
                 }
-                
-                self.send_json_response(response)
-            except Exception as e:
-                print(f"[ERROR] Embeddings failed: {e}")
-                import traceback
-                traceback.print_exc()
-                self.send_json_response({"error": str(e)}, 500)
-            return
+            }
+            
+            self.send_json_response(response)
+        except Exception as e:
+            logger.exception(f"[ERROR] Chat completion failed: {e}")
+            self.send_json_response({"error": str(e)}, 500)
+    
+    def _write_chunk(self, data: bytes):
+        """Write one chunk of a Transfer-Encoding: chunked body."""
+        self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+    
+    def _stream_chat(self, messages: List[Dict[str, Any]], max_tokens: int,
+                     temperature: float, model: str):
+        """Send a chat completion as OpenAI-style SSE chunks while it generates."""
+        created = int(time.time())
         
-        # Chat completions endpoint
-        if path == "/v1/chat/completions":
-            try:
-                messages = data.get("messages", [])
-                max_tokens = data.get("max_tokens", 512)
-                
-                if not messages:
-                    self.send_json_response({"error": "No messages provided"}, 400)
-                    return
-                
-                response_text = model_manager.chat(messages, max_tokens=max_tokens)
-                
-                response = {
-                    "id": f"chatcmpl-{int(time.time())}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": data.get("model", "lfm-2-vision-450m"),
-                    "choices": [
-                        {
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": response_text
-                            },
-                            "finish_reason": "stop"
-                        }
-                    ],
-                    "usage": {
-                        "prompt_tokens": 0,
-                        "completion_tokens": 0,
-                        "total_tokens": 0
-                    }
-                }
-                
-                self.send_json_response(response)
-            except Exception as e:
-                print(f"[ERROR] Chat completion failed: {e}")
-                import traceback
-                traceback.print_exc()
-                self.send_json_response({"error": str(e)}, 500)
-            return
+        def event(delta: Dict[str, str], finish_reason: Optional[str] = None) -> bytes:
+            return b"data: " + dump_json({
+                "id": f"chatcmpl-{created}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }) + b"\n\n"
         
-        # Add memory
-        if path == "/v1/memories/" and HAS_MEM0 and memory:
-            try:
-                messages = data.get("messages", [])
-                user_id = data.get("user_id", "default_user")
-                agent_id = data.get("agent_id")
-                metadata = data.get("metadata", {})
-                
-                content = " ".join([m.get("content", "") for m in messages if m.get("content")])
-                
-                result = memory.add(
-                    messages=messages,
-                    user_id=user_id,
-                    agent_id=agent_id,
-                    metadata=metadata,
-                    infer=False  # Skip LLM fact extraction for local models
-                )
-                
-                response = {
-                    "id": result.get("id", str(uuid.uuid4())),
-                    "content": content,
-                    "user_id": user_id,
-                    "metadata": metadata,
-                    "created_at": datetime.now().isoformat()
-                }
-                self.send_json_response(response, 201)
-            except Exception as e:
-                print(f"[ERROR] Add memory failed: {e}")
-                import traceback
-                traceback.print_exc()
-                self.send_json_response({"error": str(e)}, 500)
-            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # Length is unknown up front, so the connection stays reusable via chunking
+        self.send_header("Transfer-Encoding", "chunked")
+        self._send_cors_headers()
+        self.end_headers()
         
-        # Search memories
-        if path == "/v1/memories/search/" and HAS_MEM0 and memory:
-            try:
-                query = data.get("query", "")
-                user_id = data.get("user_id", "default_user")
-                agent_id = data.get("agent_id")
-                limit = data.get("limit", 10)
-                
+        pieces = model_manager.chat_stream(messages, max_tokens=max_tokens, temperature=temperature)
+        try:
+            self._write_chunk(event({"role": "assistant", "content": ""}))
+            for piece in pieces:
+                self._write_chunk(event({"content": piece}))
+            self._write_chunk(event({}, "stop") + b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info("[INFO] Client disconnected during streaming")
+            self.close_connection = True
+        except Exception as e:
+            # Headers are already out; all we can do is end the stream
+            logger.exception(f"[ERROR] Chat stream failed: {e}")
+            self.close_connection = True
+        finally:
+            # Stops generation if the loop above was cut short
+            pieces.close()
+    
+    # Add memory
+    def _handle_add(self, data):
+        if memory is None:
+            self.send_json_response({"error": "Not found"}, 404)
+            return
+        try:
+            messages = data.get("messages", [])
+            user_id = data.get("user_id", "default_user")
+            agent_id = data.get("agent_id")
+            metadata = data.get("metadata", {})
+            
+            content = " ".join([m.get("content", "") for m in messages if m.get("content")])
+            
+            result = memory.add(
+                messages=messages,
+                user_id=user_id,
+                agent_id=agent_id,
+                metadata=metadata,
+                infer=False  # Skip LLM fact extraction for local models
+            )
+            search_cache.clear()
+            
+            response = {
+                "id": result.get("id", str(uuid.uuid4())),
+                "content": content,
+                "user_id": user_id,
+                "metadata": metadata,
+                "created_at": datetime.now().isoformat()
+            }
+            self.send_json_response(response, 201)
+        except Exception as e:
+            logger.exception(f"[ERROR] Add memory failed: {e}")
+            self.send_json_response({"error": str(e)}, 500)
+    
+    # Search memories
+    def _handle_search(self, data):
+        if memory is None:
+            self.send_json_response({"error": "Not found"}, 404)
+            return
+        try:
+            query = data.get("query", "")
+            user_id = data.get("user_id", "default_user")
+            agent_id = data.get("agent_id")
+            limit = data.get("limit", 10)
+            
+            # Near-duplicate queries reuse an earlier search; the query
+            # vector is cached, so Mem0's own embed of it is free
+            query_vec = None
+            results = None
+            scope = (user_id, agent_id, limit)
+            if SEMANTIC_CACHE_SIZE > 0 and query:
+                query_vec = embedding_batcher.submit([query])[0]
+                results = search_cache.get(query_vec, scope)
+            if results is None:
                 results = memory.search(
                     query=query,
                     user_id=user_id,
                     agent_id=agent_id,
                     limit=limit
                 )
-                
-                search_results = []
-                for r in results:
-                    if isinstance(r, dict):
-                        search_results.append({
-                            "memory": {
-                                "id": r.get("id", str(uuid.uuid4())),
-                                "content": r.get("memory", ""),
-                                "user_id": user_id,
-                                "metadata": r.get("metadata", {}),
-                                "created_at": r.get("created_at", datetime.now().isoformat())
-                            },
-                            "score": r.get("score", 0.0),
-                            "distance": r.get("distance", 0.0)
-                        })
-                    elif isinstance(r, str):
-                        search_results.append({
-                            "memory": {
-                                "id": str(uuid.uuid4()),
-                                "content": r,
-                                "user_id": user_id,
-                                "metadata": {},
-                                "created_at": datetime.now().isoformat()
-                            },
-                            "score": 1.0,
-                            "distance": 0.0
-                        })
-                
-                self.send_json_response(search_results)
-            except Exception as e:
-                print(f"[ERROR] Search failed: {e}")
-                self.send_json_response({"error": str(e)}, 500)
-            return
-        
-        self.send_json_response({"error": "Not found"}, 404)
+                if query_vec is not None:
+                    search_cache.put(query_vec, scope, results)
+            
+            # One timestamp per response; defaults are built only when missing
+            now_iso = datetime.now().isoformat()
+            search_results = [_search_row(r, user_id, now_iso) for r in _result_rows(results)]
+            
+            self.send_json_response(search_results)
+        except Exception as e:
+            logger.error(f"[ERROR] Search failed: {e}")
+            self.send_json_response({"error": str(e)}, 500)
     
-    def do_DELETE(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        
-        if path.startswith("/v1/memories/"):
-            self.send_json_response({"deleted": True})
-            return
-        
-        self.send_json_response({"error": "Not found"}, 404)
+    # Exact-path dispatch tables; query strings are parsed only where used
+    GET_ROUTES = {
+        "/health": _handle_health,
+        "/v1/models": _handle_models,
+        "/v1/memories/": _handle_list,
+    }
+    POST_ROUTES = {
+        "/v1/embeddings": _handle_embeddings,
+        "/v1/chat/completions": _handle_chat,
+        "/v1/memories/": _handle_add,
+        "/v1/memories/search/": _handle_search,
+    }
 
 
 # ============================================================================
 # Main
 # ============================================================================
 
+class Mem0HTTPServer(ThreadingHTTPServer):
+    """Threaded server with one thread per connection.
+    
+    Keep-alive connections stay open between requests. A fixed worker pool
+    would let idle connections starve new ones, so threads scale with
+    connections instead.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+    
+    def server_bind(self):
+        if MEM0_PROCESSES > 1:
+            # Sibling processes bind the same port; the kernel spreads connections
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
 def main():
     """Main entry point."""
     
@@ -711,13 +1444,18 @@ def main():
     print("Press Ctrl+C to stop")
     print()
     
-    server = HTTPServer((HOST, PORT), Mem0LocalHandler)
+    # A slow add or chat completion must not hold up other requests,
+    # so each connection is served on its own thread
+    server = Mem0HTTPServer((HOST, PORT), Mem0LocalHandler)
     
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print("\n[INFO] Shutting down...")
         server.shutdown()
+        if model_manager.disk_cache is not None:
+            model_manager.disk_cache.close()
+        log_listener.stop()
 
 
 if __name__ == "__main__":
@@ -17,6 +17,7 @@ import sys
 import json
 import uuid
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
@@ -34,6 +35,13 @@ PORT = int(os.getenv("MEM0_PORT", "8000"))
 LM_STUDIO_URL = os.getenv("LM_STUDIO_URL", "http://localhost:1234/v1").rstrip('/')
 CEREBRAS_API_KEY = os.getenv("CEREBRAS_API_KEY", "")
 
+# Pooled keep-alive connections to LM Studio and Cerebras, so each call
+# skips the TCP (and for Cerebras, TLS) handshake
+LM_SESSION = requests.Session()
+LM_SESSION.headers["Connection"] = "keep-alive"
+LM_SESSION.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+LM_SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
 print("="*70)
 print("Mem0 Server: Cerebras (Chat) + LM Studio (Classification + Embeddings)")
 print("="*70)
@@ -50,7 +58,7 @@ class LMStudioClient:
         
     def connect(self):
         try:
-            resp = requests.get(f"{self.base_url}/models", timeout=5)
+            resp = LM_SESSION.get(f"{self.base_url}/models", timeout=5)
             if resp.status_code == 200:
                 models = resp.json().get('data', [])
                 print(f"[OK] LM Studio: {len(models)} model(s)")
@@ -90,7 +98,7 @@ REASON: one line"""
         }
         
         try:
-            resp = requests.post(url, json=payload, timeout=30)
+            resp = LM_SESSION.post(url, json=payload, timeout=30)
             content = resp.json()["choices"][0]["message"]["content"]
             is_useful = "USEFUL" in content.upper() and "DISCARD" not in content.upper()
             reason = content.split("REASON:")[1].strip() if "REASON:" in content else ""
@@ -106,7 +114,7 @@ REASON: one line"""
         results = []
         for text in texts:
             try:
-                resp = requests.post(url, json={
+                resp = LM_SESSION.post(url, json={
                     "model": self.embedding_model,
                     "input": text
                 }, timeout=30)
@@ -151,7 +159,7 @@ class CerebrasClient:
         headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
         
         try:
-            resp = requests.post(url, json=payload, headers=headers, timeout=60)
+            resp = LM_SESSION.post(url, json=payload, headers=headers, timeout=60)
             return resp.json()["choices"][0]["message"]["content"]
         except Exception as e:
             print(f"[ERROR] Chat failed: {e}")